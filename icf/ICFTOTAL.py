@@ -2,23 +2,38 @@ import numpy as np
 from scipy.optimize import minimize
 import numba
 
+@numba.njit(parallel=True, cache=True)
+def center_of_mass_sums(image, mask):
+    """
+    Sums over the valid pixels in one row-parallel pass, without index grids or
+    masked copies. Returns (total intensity, sum of x*intensity, sum of y*intensity).
+    """
+    rows, cols = image.shape
+    s = 0.0
+    sx = 0.0
+    sy = 0.0
+    for y in numba.prange(rows):
+        for x in range(cols):
+            if mask[y, x]:
+                v = np.float64(image[y, x])
+                s += v
+                sx += x * v
+                sy += y * v
+    return s, sx, sy
+
 def center_of_mass_initial_guess(image, mask):
     """
     Compute a rough center-of-mass (CoM) for the image using valid pixels only.
     This will serve as our initial guess for the diffraction center.
     """
-    rows, cols = np.indices(image.shape)
-    valid_intensity = image[mask]
-    valid_rows = rows[mask]
-    valid_cols = cols[mask]
-    total_intensity = np.sum(valid_intensity)
+    total_intensity, sum_x, sum_y = center_of_mass_sums(image, mask)
     if total_intensity == 0:
         return (image.shape[1] / 2.0, image.shape[0] / 2.0)
-    cx = np.sum(valid_cols * valid_intensity) / total_intensity
-    cy = np.sum(valid_rows * valid_intensity) / total_intensity
+    cx = sum_x / total_intensity
+    cy = sum_y / total_intensity
     return (cx, cy)
 
-@numba.njit
+@numba.njit(cache=True)
 
 def compute_bin_medians(wedge_vals, bin_indices, n_bins):
     result = np.empty(n_bins, dtype=np.float64)
@@ -177,3 +192,17 @@ def find_diffraction_center(image, mask, initial_center=None,
         print("Final refined center:", refined_center)
     
     return tuple(refined_center)
+
+def warm_up_kernels():
+    """
+    Compile (or load from Numba's on-disk cache) the kernels used by
+    find_diffraction_center, on a tiny float32 image. Each pool worker calls this
+    in its initializer, so it loads the cached kernels once before its first task
+    rather than on its first frame.
+    """
+    image = np.ones((16, 16), dtype=np.float32)
+    mask = np.ones((16, 16), dtype=bool)
+    initial_center = center_of_mass_initial_guess(image, mask)
+    # A uniform image is perfectly symmetric, so this evaluates the metric once and returns.
+    find_diffraction_center(image, mask, initial_center=initial_center,
+                            n_rad_bins=4, verbose=False, skip_tol=np.inf)
@@ -1,4 +1,5 @@
 import os
+import functools
 import h5py
 import numpy as np
 import ipywidgets as widgets
@@ -8,6 +9,38 @@ from IPython.display import display, clear_output
 # Import your updated processing function.
 from image_processing import process_images_apply_async
 
+def read_mask(dset):
+    """
+    Reads a mask dataset into a boolean array (non-zero = valid pixel). One-byte masks
+    (bool, uint8, int8) are read straight into the output buffer and converted in
+    place, so no second full-size copy is made; other dtypes are read and converted.
+    """
+    if dset.dtype.itemsize == 1 and dset.dtype.kind in 'biu':
+        buf = np.empty(dset.shape, dtype=dset.dtype)
+        dset.read_direct(buf)
+        mask = buf.view(bool)
+        np.not_equal(buf, 0, out=mask)
+        return mask
+    return dset[()].astype(bool)
+
+@functools.lru_cache(maxsize=4)
+def _load_mask(mask_file, use_mask, mtime):
+    """
+    Loads the mask from mask_file (or an all-True mask of the same frame shape when
+    use_mask is False). Cached on (path, use_mask, mtime), so repeated runs with the same
+    mask file skip the read; the mtime makes an edited file be read again.
+    The returned array is read-only because it is shared between runs.
+    """
+    with h5py.File(mask_file, 'r') as f_mask:
+        dset = f_mask['/mask']
+        if use_mask:
+            mask = read_mask(dset)
+        else:
+            # Only the frame shape is needed, which comes from the metadata.
+            mask = np.ones(dset.shape[-2:], dtype=bool)
+    mask.flags.writeable = False
+    return mask
+
 def create_center_finding_section():
     """
     Creates a UI for selecting:
@@ -22,7 +55,7 @@ def create_center_finding_section():
         <h4>Center Finding for Diffraction Images</h4>
         <p>
         Select your H5 image file and a mask file, then set parameters to find the diffraction center.<br>
-        A CSV with the found centers will be created in the same folder as the selected image file.<br>
+        A CSV (or Parquet) file with the found centers will be created in the same folder as the selected image file.<br>
         The progress bar will update for each computed center.
         </p>
         """
@@ -44,6 +77,7 @@ def create_center_finding_section():
     xatol_widget = widgets.FloatText(value=0.01, description="xatol:")
     frame_interval_widget = widgets.IntText(value=10, description="Frame Interval:")
     verbose_checkbox = widgets.Checkbox(value=False, description="Verbose")
+    output_format_widget = widgets.Dropdown(options=["csv", "parquet"], value="csv", description="Output:")
 
     xmin_widget = widgets.IntText(value=400, description="xmin:")
     xmax_widget = widgets.IntText(value=600, description="xmax:")
@@ -73,14 +107,9 @@ def create_center_finding_section():
                 print("Please select a mask H5 file.")
                 return
 
-            # Load or create mask.
+            # Load or create mask (cached between runs).
             try:
-                with h5py.File(mask_file, 'r') as f_mask:
-                    if use_mask_checkbox.value:
-                        mask = f_mask['/mask'][:].astype(bool)
-                    else:
-                        sample = f_mask['/mask'][0]
-                        mask = np.ones_like(sample, dtype=bool)
+                mask = _load_mask(mask_file, use_mask_checkbox.value, os.path.getmtime(mask_file))
             except Exception as e:
                 print("Error loading mask file:", e)
                 return
@@ -111,7 +140,8 @@ def create_center_finding_section():
                 xmax=xmax_val,
                 ymin=ymin_val,
                 ymax=ymax_val,
-                verbose=verbose_val
+                verbose=verbose_val,
+                output_format=output_format_widget.value
             )
             print("Processing completed.")
 
@@ -124,6 +154,7 @@ def create_center_finding_section():
         mask_file_chooser,
         use_mask_checkbox,
         widgets.HBox([xatol_widget, frame_interval_widget, verbose_checkbox]),
+        output_format_widget,
         widgets.HBox([xmin_widget, xmax_widget, ymin_widget, ymax_widget]),
         process_button,
         output_area
@@ -1,4 +1,5 @@
 import os
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from ipywidgets import (
@@ -12,7 +13,7 @@ def get_ui():
     # File chooser widget to browse for a CSV file.
     csv_file_chooser = FileChooser(os.getcwd())
     csv_file_chooser.title = "Select CSV File with Center Data"
-    csv_file_chooser.filter_pattern = "*.csv"
+    csv_file_chooser.filter_pattern = ["*.csv", "*.parquet"]
     
     # Button to trigger CSV loading.
     load_button = Button(description="Load CSV", button_style="primary")
@@ -34,11 +35,12 @@ def get_ui():
                 print("No CSV loaded.")
             return
         
-        # Calculate slider default values from the CSV.
-        x_min_default = df['center_x'].min()
-        x_max_default = df['center_x'].max()
-        y_min_default = df['center_y'].min()
-        y_max_default = df['center_y'].max()
+        # Calculate slider default values from the CSV (both columns in one aggregation).
+        bounds = df[['center_x', 'center_y']].agg(['min', 'max'])
+        x_min_default = bounds.loc['min', 'center_x']
+        x_max_default = bounds.loc['max', 'center_x']
+        y_min_default = bounds.loc['min', 'center_y']
+        y_max_default = bounds.loc['max', 'center_y']
         
         def filter_and_plot(x_range, y_range, remove_outliers, outlier_std):
             if df.empty:
@@ -48,34 +50,25 @@ def get_ui():
             x_min, x_max = x_range
             y_min, y_max = y_range
             
-            # Create a copy of the DataFrame to modify.
+            # Work on float arrays of the centers; rows that fail the filter become NaN,
+            # which are written as empty fields.
             df_filtered = df.copy()
-            # Ensure center_x and center_y can store empty strings.
-            df_filtered['center_x'] = df_filtered['center_x'].astype(object)
-            df_filtered['center_y'] = df_filtered['center_y'].astype(object)
+            cx = df_filtered['center_x'].to_numpy(dtype=float)
+            cy = df_filtered['center_y'].to_numpy(dtype=float)
             
             # Create mask for rows with center values within the selected range.
-            mask_range = (
-                (df_filtered['center_x'].astype(float) >= x_min) & 
-                (df_filtered['center_x'].astype(float) <= x_max) &
-                (df_filtered['center_y'].astype(float) >= y_min) & 
-                (df_filtered['center_y'].astype(float) <= y_max)
-            )
+            mask_range = (cx >= x_min) & (cx <= x_max) & (cy >= y_min) & (cy <= y_max)
             
             # If outlier removal is enabled, compute additional mask on the in-range rows.
             if remove_outliers:
-                valid_in_range = df_filtered[mask_range].copy()
-                # Convert to float for calculations.
-                valid_in_range['center_x'] = valid_in_range['center_x'].astype(float)
-                valid_in_range['center_y'] = valid_in_range['center_y'].astype(float)
-                if not valid_in_range.empty:
-                    x_mean = valid_in_range['center_x'].mean()
-                    x_std = valid_in_range['center_x'].std()
-                    y_mean = valid_in_range['center_y'].mean()
-                    y_std = valid_in_range['center_y'].std()
+                if mask_range.any():
+                    x_mean = cx[mask_range].mean()
+                    x_std = cx[mask_range].std(ddof=1)
+                    y_mean = cy[mask_range].mean()
+                    y_std = cy[mask_range].std(ddof=1)
                     mask_outlier = (
-                        (abs(df_filtered['center_x'].astype(float) - x_mean) <= outlier_std * x_std) &
-                        (abs(df_filtered['center_y'].astype(float) - y_mean) <= outlier_std * y_std)
+                        (np.abs(cx - x_mean) <= outlier_std * x_std) &
+                        (np.abs(cy - y_mean) <= outlier_std * y_std)
                     )
                 else:
                     mask_outlier = mask_range
@@ -83,39 +76,30 @@ def get_ui():
             else:
                 valid_mask = mask_range
             
-            # For rows that do not satisfy the filter, replace center_x and center_y with empty strings.
-            df_filtered.loc[~valid_mask, ['center_x', 'center_y']] = ""
+            # For rows that do not satisfy the filter, replace center_x and center_y with NaN.
+            df_filtered['center_x'] = np.where(valid_mask, cx, np.nan)
+            df_filtered['center_y'] = np.where(valid_mask, cy, np.nan)
             
             # Print statistics only for the valid rows.
             valid_rows = df_filtered[valid_mask]
             print("=== Valid Data Statistics ===")
             print(f"Number of valid rows: {len(valid_rows)} out of {len(df_filtered)}")
+            stats = valid_rows[['center_x', 'center_y']].agg(['mean', 'median', 'std'])
             for col in ['center_x', 'center_y']:
-                # Convert to float for calculation if possible.
-                try:
-                    valid_floats = valid_rows[col].astype(float)
-                    mean_val = valid_floats.mean()
-                    median_val = valid_floats.median()
-                    std_val = valid_floats.std()
-                    print(f"{col} => mean: {mean_val:.3f}, median: {median_val:.3f}, std: {std_val:.3f}")
-                except Exception:
-                    print(f"{col} has non-numeric values.")
+                mean_val, median_val, std_val = stats[col]
+                print(f"{col} => mean: {mean_val:.3f}, median: {median_val:.3f}, std: {std_val:.3f}")
             
             # Save the modified CSV in the same folder as the input.
             output_folder = os.path.dirname(csv_path)
             base = os.path.basename(csv_path)
             basename, ext = os.path.splitext(base)
             output_filename = os.path.join(output_folder, f"{basename}_filtered.csv")
-            df_filtered.to_csv(output_filename, index=False)
+            df_filtered.to_csv(output_filename, index=False, na_rep="")
             print(f"\nFiltered CSV saved to: {output_filename}\n")
             
-            # Plot scatter using only the valid rows (converted back to float for plotting).
-            valid_rows_numeric = valid_rows.copy()
-            valid_rows_numeric['center_x'] = valid_rows_numeric['center_x'].apply(lambda v: float(v) if v != "" else None)
-            valid_rows_numeric['center_y'] = valid_rows_numeric['center_y'].apply(lambda v: float(v) if v != "" else None)
-            valid_rows_numeric = valid_rows_numeric.dropna(subset=['center_x', 'center_y'])
+            # Plot scatter using only the valid rows (numeric already; NaN centers never pass the range filter).
             plt.figure(figsize=(8, 6))
-            plt.scatter(valid_rows_numeric['center_x'], valid_rows_numeric['center_y'], marker='o')
+            plt.scatter(valid_rows['center_x'], valid_rows['center_y'], marker='o')
             plt.xlabel('Center X')
             plt.ylabel('Center Y')
             plt.title('Scatter Plot of Valid Center Coordinates')
@@ -124,7 +108,7 @@ def get_ui():
             
             # Plot histogram for center_x.
             plt.figure(figsize=(8, 6))
-            plt.hist(valid_rows_numeric['center_x'], bins=30, edgecolor='black')
+            plt.hist(valid_rows['center_x'], bins=30, edgecolor='black')
             plt.xlabel('Center X')
             plt.ylabel('Frequency')
             plt.title('Histogram of Valid Center X')
@@ -133,7 +117,7 @@ def get_ui():
             
             # Plot histogram for center_y.
             plt.figure(figsize=(8, 6))
-            plt.hist(valid_rows_numeric['center_y'], bins=30, edgecolor='black')
+            plt.hist(valid_rows['center_y'], bins=30, edgecolor='black')
             plt.xlabel('Center Y')
             plt.ylabel('Frequency')
             plt.title('Histogram of Valid Center Y')
@@ -175,7 +159,10 @@ def get_ui():
                 print("Please browse and select a CSV file.")
                 return
             try:
-                df_loaded = pd.read_csv(selected)
+                if selected.endswith(".parquet"):
+                    df_loaded = pd.read_parquet(selected)
+                else:
+                    df_loaded = pd.read_csv(selected)
                 state["df"] = df_loaded
                 state["csv_path"] = selected
                 print(f"Loaded {len(df_loaded)} rows from {selected}")
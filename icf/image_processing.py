@@ -4,31 +4,140 @@ import os
 import time
 import h5py
 import numpy as np
+import numba
 import pandas as pd
 from tqdm import tqdm
-from multiprocessing import Pool
+from multiprocessing import cpu_count, get_all_start_methods, get_context, shared_memory
 
-from ICFTOTAL import center_of_mass_initial_guess, find_diffraction_center
+# pyarrow's CSV writer is much faster than DataFrame.to_csv; fall back to pandas without it.
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
 
-def compute_center_for_frame(args):
+from ICFTOTAL import center_of_mass_initial_guess, find_diffraction_center, warm_up_kernels
+
+# Per-worker state, set once by init_worker.
+_worker_mask = None
+_worker_shm = None
+_worker_file = None
+_worker_images = None
+_worker_memmap = None
+_worker_frames = None
+
+def init_worker(image_file, cache_nbytes, shm_name, mask_shape, mask_dtype):
+    """
+    Pool initializer: opens the H5 file once for the lifetime of the worker (so its chunk
+    cache survives between tasks) and attaches to the shared-memory block holding the mask,
+    keeping a read-only view of it as a module global so the mask is never pickled per task.
+    A contiguous, uncompressed image dataset is additionally memory-mapped so frames can be
+    read without going through h5py at all.
+    """
+    global _worker_mask, _worker_shm, _worker_file, _worker_images, _worker_memmap
+    _worker_file = h5py.File(image_file, 'r', rdcc_nbytes=cache_nbytes, rdcc_nslots=10007)
+    _worker_images = _worker_file['/entry/data/images']
+    _worker_memmap = memmap_contiguous_dataset(image_file, _worker_images)
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_mask = np.ndarray(mask_shape, dtype=mask_dtype, buffer=_worker_shm.buf)
+    _worker_mask.flags.writeable = False
+    # The pool already runs one worker per core, so each worker runs the parallel
+    # Numba kernels on a single thread instead of starting a core-sized thread pool.
+    numba.set_num_threads(1)
+    # Compile (or load from the Numba cache) the kernels before the first task arrives.
+    warm_up_kernels()
+
+def compute_centers_for_chunk(args):
     """
     Helper function for multiprocessing.
-    Loads one frame from the H5 file, processes it, and returns (frame_num, center_x, center_y).
-    If the computed center is invalid or out-of-bounds, returns NaN values.
+    Loads a chunk of frames from the worker's open H5 file with a single read, processes each frame,
+    and returns the arrays (frame_nums, center_x, center_y).
+    If a computed center is invalid or out-of-bounds, NaN values are returned for that frame.
     """
-    (frame_num, image_file, mask, n_wedges, n_rad_bins,
+    global _worker_frames
+    (frame_nums, n_wedges, n_rad_bins,
      xatol, fatol, verbose, xmin, xmax, ymin, ymax) = args
+    mask = _worker_mask
 
-    with h5py.File(image_file, 'r') as f:
-        img = f['/entry/data/images'][frame_num].astype(np.float32)
+    # h5py point selections must be strictly increasing; sort (and de-duplicate) the
+    # chunk so it is always fetched with one monotonic selection. Each result carries
+    # its frame number, so the processing order does not matter to the caller.
+    # The frames are read straight into the worker's float32 scratch buffer, so HDF5
+    # does the dtype conversion during the read and no per-frame copy is made.
+    frame_nums = np.unique(frame_nums)
+    n = len(frame_nums)
+    if _worker_frames is None or _worker_frames.shape[0] < n:
+        _worker_frames = np.empty((n,) + _worker_images.shape[1:], dtype=np.float32)
+    frames = _worker_frames[:n]
+    if _worker_memmap is not None:
+        for i, frame_num in enumerate(frame_nums):
+            frames[i] = _worker_memmap[frame_num]
+    else:
+        _worker_images.read_direct(frames, source_sel=np.s_[frame_nums])
+
+    cx_arr = np.empty(n, dtype=float)
+    cy_arr = np.empty(n, dtype=float)
+    for i, img in enumerate(frames):
+        cx_arr[i], cy_arr[i] = process_single_image(img, mask, n_wedges, n_rad_bins, xatol, fatol, verbose, xmin, xmax, ymin, ymax)
 
-    cx, cy = process_single_image(img, mask, n_wedges, n_rad_bins, xatol, fatol, verbose, xmin, xmax, ymin, ymax)
+    # Invalidate non-finite or out-of-bounds centers for the whole chunk at once.
+    valid = (np.isfinite(cx_arr) & np.isfinite(cy_arr) &
+             (cx_arr >= xmin) & (cx_arr < xmax) & (cy_arr >= ymin) & (cy_arr < ymax))
+    cx_arr[~valid] = np.nan
+    cy_arr[~valid] = np.nan
+
+    return frame_nums, cx_arr, cy_arr
+
+def memmap_contiguous_dataset(path, dset):
+    """
+    Returns a read-only np.memmap over dset when it is stored contiguously, uncompressed
+    and inside the file itself (so its raw bytes sit at a fixed offset), otherwise None.
+    """
+    if dset.chunks is not None or dset.compression is not None or dset.external:
+        return None
+    offset = dset.id.get_offset()
+    if offset is None:
+        # Storage not allocated yet (nothing has been written).
+        return None
+    return np.memmap(path, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+
+def chunk_cache_nbytes(dset, min_nbytes=64 * 1024 * 1024):
+    """
+    Size of the HDF5 chunk cache for reading dset: at least min_nbytes, and always
+    room for two chunks. A chunk larger than the cache bypasses it and is decompressed
+    again for every frame read from it.
+    """
+    if dset.chunks is None:
+        return min_nbytes
+    return max(min_nbytes, 2 * int(np.prod(dset.chunks)) * dset.dtype.itemsize)
 
-    if not (np.isfinite(cx) and np.isfinite(cy) and
-            xmin <= cx < xmax and ymin <= cy < ymax):
-        cx, cy = np.nan, np.nan
+def split_frames_by_chunk(frames, chunk_len, max_frames):
+    """
+    Splits sorted frame numbers into groups of about max_frames frames without separating
+    frames that live in the same HDF5 chunk (chunk_len frames along axis 0), so every
+    touched chunk is read and decompressed by a single worker.
+    """
+    groups = []
+    current = []
+    for fn in frames:
+        if len(current) >= max_frames and fn // chunk_len != current[-1] // chunk_len:
+            groups.append(current)
+            current = []
+        current.append(fn)
+    if current:
+        groups.append(current)
+    return groups
 
-    return frame_num, cx, cy
+def read_index_for_frames(index_dset, n_images, frame_interval):
+    """
+    Reads the data index of every frame_interval-th frame plus the last frame, i.e. of the
+    frames to process, with one strided read instead of loading the whole index dataset
+    (an h5py fancy selection of the same frames is far slower than either).
+    """
+    data_index = index_dset[::frame_interval]
+    if (n_images - 1) % frame_interval:
+        data_index = np.append(data_index, index_dset[n_images - 1])
+    return data_index
 
 def process_single_image(img, mask, n_wedges, n_rad_bins, xatol, fatol, verbose, xmin, xmax, ymin, ymax):
     # Get the initial center-of-mass guess.
@@ -63,72 +172,103 @@ def process_images_apply_async(
     xmax=1024,
     ymin=0,
     ymax=1024,
-    verbose=False
+    verbose=False,
+    frames_per_chunk=16,
+    output_format="csv"
 ):
     """
-    Processes the specified frames from the H5 image file in parallel using apply_async
-    (without chunking) so that the progress bar is updated for every computed center.
-    Results are stored in a CSV in the same folder as the image file.
+    Processes the specified frames from the H5 image file in parallel.
+    Frames are handed to the workers in chunks of about frames_per_chunk, aligned to the
+    HDF5 chunks of the image dataset, so that each worker reads its frames with a single
+    H5 read; the progress bar is updated per finished chunk.
+    Each worker opens the H5 file once at start-up and attaches to the mask, which is
+    placed in shared memory once.
+    Results are stored in a CSV in the same folder as the image file, or in a Parquet
+    file (faster to write and read back, keeps column dtypes) when output_format="parquet".
     """
-    # 1) Open the H5 file to get the number of images and index dataset.
+    # 1) Open the H5 file to get the number of images, identify which frames to process
+    #    and read the index of those frames only (one strided read plus the last frame).
     with h5py.File(image_file, 'r') as f:
-        n_images = f['/entry/data/images'].shape[0]
+        images = f['/entry/data/images']
+        n_images = images.shape[0]
+        chunk_len = images.chunks[0] if images.chunks is not None else 1
+        cache_nbytes = chunk_cache_nbytes(images)
+        frames_to_process = np.union1d(np.arange(0, n_images, frame_interval), [0, n_images - 1])
         index_dset = f.get('/entry/data/index')
-        if index_dset is not None:
-            data_index_all = index_dset[:]
-        else:
+        if index_dset is None:
             raise ValueError("Dataset '/entry/data/index' is required but not found.")
+        data_index_sel = read_index_for_frames(index_dset, n_images, frame_interval)
 
-    # 2) Create a DataFrame to store centers.
-    df = pd.DataFrame({
-        "frame_number": np.arange(n_images),
-        "data_index": data_index_all,
-        "center_x": np.full(n_images, np.nan, dtype=float),
-        "center_y": np.full(n_images, np.nan, dtype=float),
-    })
-
-    # 3) Identify which frames to process.
-    frames_to_process = set([0, n_images - 1]) | {i for i in range(n_images) if i % frame_interval == 0}
-    frames_to_process = sorted(frames_to_process)
+    # 2) Preallocate the center arrays, one entry per frame to process
+    #    (n_images comes from the H5 metadata, not from the results).
+    n_rows = len(frames_to_process)
+    center_x = np.full(n_rows, np.nan, dtype=float)
+    center_y = np.full(n_rows, np.nan, dtype=float)
 
-    # 4) Build a list of tasks.
+    # 3) Build a list of tasks, one per group of frames aligned to the HDF5 chunks.
+    #    The mask is not part of the task; the workers read it from shared memory.
+    mask = np.asarray(mask, dtype=bool)
     tasks = []
-    for fn in frames_to_process:
+    for frame_nums in split_frames_by_chunk(frames_to_process, chunk_len, frames_per_chunk):
         tasks.append((
-            fn,         # frame number
-            image_file, # image file path
-            mask,
+            frame_nums, # frame numbers
             n_wedges, n_rad_bins,
             xatol, fatol,
             verbose,
             xmin, xmax, ymin, ymax
         ))
 
-    # 5) Create a tqdm progress bar.
-    pbar = tqdm(total=len(tasks), desc="Processing frames", unit="frame")
+    # 4) Create a tqdm progress bar.
+    pbar = tqdm(total=len(frames_to_process), desc="Processing frames", unit="frame")
 
-    # 6) Define a callback to update the progress bar and DataFrame.
-    def update_callback(result):
-        frame_num, cx, cy = result
-        df.at[frame_num, "center_x"] = cx
-        df.at[frame_num, "center_y"] = cy
-        pbar.update(1)
+    # 5) Copy the mask into a shared-memory block for the workers.
+    shm = shared_memory.SharedMemory(create=True, size=max(mask.nbytes, 1))
+    try:
+        shm_mask = np.ndarray(mask.shape, dtype=mask.dtype, buffer=shm.buf)
+        shm_mask[:] = mask
 
-    # 7) Process each task individually using apply_async.
-    with Pool() as pool:
-        async_results = [pool.apply_async(compute_center_for_frame, args=(task,), callback=update_callback)
-                         for task in tasks]
-        # Wait for all tasks to finish.
-        [res.get() for res in async_results]
+        # 6) Process the chunks as they finish, updating the progress bar and center arrays.
+        #    Numba's TBB worker threads do not survive fork(): once this process has run a
+        #    parallel kernel (e.g. the LOWESS fit in the same GUI), forked workers leave it
+        #    hanging at exit. The workers are therefore started from a forkserver where there is one.
+        ctx = get_context("forkserver" if "forkserver" in get_all_start_methods() else None)
+        n_procs = cpu_count()
+        chunksize = max(1, len(tasks) // (4 * n_procs))
+        with ctx.Pool(n_procs, initializer=init_worker,
+                      initargs=(image_file, cache_nbytes, shm.name, mask.shape, mask.dtype.str)) as pool:
+            for frame_nums, cxs, cys in pool.imap_unordered(compute_centers_for_chunk, tasks, chunksize=chunksize):
+                rows = np.searchsorted(frames_to_process, frame_nums)
+                center_x[rows] = cxs
+                center_y[rows] = cys
+                pbar.update(len(frame_nums))
+            # Let the workers exit on their own (leaving the block would terminate them).
+            pool.close()
+            pool.join()
+        del shm_mask
+    finally:
+        shm.close()
+        shm.unlink()
 
     pbar.close()
 
-    # 8) Keep only rows for frames that were processed and write out the CSV
-    df = df[df["frame_number"].isin(frames_to_process)]
-
-    csv_file = os.path.join(
+    # 7) Build the DataFrame once and write out the CSV (or Parquet)
+    df = pd.DataFrame({
+        "frame_number": frames_to_process,
+        "data_index": data_index_sel,
+        "center_x": center_x,
+        "center_y": center_y,
+    })
+    out_base = os.path.join(
         os.path.dirname(image_file),
-        f"centers_xatol_{xatol}_frameinterval_{frame_interval}.csv"
+        f"centers_xatol_{xatol}_frameinterval_{frame_interval}"
     )
-    df.to_csv(csv_file, index=False)
-    print(f"Created CSV with {len(df)} found centers in {time.time()} seconds:\n{csv_file}")
+    if output_format == "parquet":
+        out_file = out_base + ".parquet"
+        df.to_parquet(out_file, index=False, compression="zstd")
+    else:
+        out_file = out_base + ".csv"
+        if pa is not None:
+            pa_csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), out_file)
+        else:
+            df.to_csv(out_file, index=False)
+    print(f"Created {output_format.upper()} with {len(df)} found centers in {time.time()} seconds:\n{out_file}")
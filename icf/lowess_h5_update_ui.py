@@ -7,8 +7,15 @@ import matplotlib.pyplot as plt
 from ipyfilechooser import FileChooser
 from IPython.display import display, clear_output
 
-# We'll use statsmodels' LOWESS.
-from statsmodels.nonparametric.smoothers_lowess import lowess
+# pyarrow's CSV writer is much faster than DataFrame.to_csv; fall back to pandas without it.
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+# LOWESS via statsmodels, or a Numba kernel for large inputs.
+from lowess_numba import lowess_grid_xy
 
 # Custom module for updating H5 files (you already have it).
 from update_h5 import create_updated_h5
@@ -17,11 +24,18 @@ from update_h5_pb import create_updated_h5_pb
 # Mutable container for storing the path to the shifted CSV.
 _shifted_csv_path = [None]
 
+# LOWESS fit of the last run (before the shifts), keyed by
+# (csv_path, csv_mtime, frac, use_numba), so changing only the shifts does not refit.
+_lowess_cache = {}
+
+# Plots are thinned to about this many points per line.
+MAX_PLOT_POINTS = 5000
+
 # ------------------------------------------------------------------------
 # UI Section 2A: LOWESS-Fit & Shift
 csv_file_chooser = FileChooser(os.getcwd())
 csv_file_chooser.title = "Select CSV From Section 1"
-csv_file_chooser.filter_pattern = "*.csv"
+csv_file_chooser.filter_pattern = ["*.csv", "*.parquet"]
 
 shift_x_widget = widgets.FloatText(value=0, description="Shift X:", layout=widgets.Layout(width="150px"))
 shift_y_widget = widgets.FloatText(value=0, description="Shift Y:", layout=widgets.Layout(width="150px"))
@@ -33,6 +47,9 @@ lowess_frac_widget = widgets.FloatSlider(
     layout=widgets.Layout(width="300px")
 )
 
+use_numba_widget = widgets.Checkbox(value=True, description="Use Numba LOWESS (large CSVs)")
+show_plot_widget = widgets.Checkbox(value=True, description="Show plot")
+
 process_csv_button = widgets.Button(description="Lowess & Save CSV", button_style="primary")
 csv_output = widgets.Output(layout={'border': '1px solid black', 'padding': '5px'})
 
@@ -45,9 +62,12 @@ def on_process_csv_clicked(b):
             print("Please select a CSV from Section 1.")
             return
 
-        # Read CSV
+        # Read CSV (or the Parquet output of Section 1)
         try:
-            df = pd.read_csv(input_csv)
+            if input_csv.endswith(".parquet"):
+                df = pd.read_parquet(input_csv)
+            else:
+                df = pd.read_csv(input_csv)
         except Exception as e:
             print(f"Error reading CSV: {e}")
             return
@@ -58,13 +78,12 @@ def on_process_csv_clicked(b):
                 print(f"CSV must contain '{col}' column.")
                 return
 
-        # Sort by data_index for consistent processing
-        df = df.sort_values("data_index").reset_index(drop=True)
-
-        # Extract columns as arrays
-        data_idx = df["data_index"].values
-        cx = df["center_x"].values
-        cy = df["center_y"].values
+        # Extract columns as arrays, sorted by data_index for consistent processing
+        data_idx = df["data_index"].to_numpy()
+        order = np.argsort(data_idx, kind="stable")
+        data_idx = data_idx[order]
+        cx = df["center_x"].to_numpy()[order]
+        cy = df["center_y"].to_numpy()[order]
 
         # Identify valid points (non-missing centers)
         valid_mask = ~np.isnan(cx) & ~np.isnan(cy)
@@ -79,49 +98,56 @@ def on_process_csv_clicked(b):
         # If we don't have enough valid points, don't bother fitting.
         if len(valid_data_idx) < 2:
             print("Too few valid points for a LOWESS fit. We'll leave all centers as-is.")
-            # Just output the original CSV but note that it won't fill missing endpoints.
-            df_smoothed = df.copy()
+            # Just output the original centers but note that it won't fill missing endpoints.
+            # Uses the already-sorted column arrays rather than copying the whole DataFrame.
+            out_idx, out_cx, out_cy = data_idx, cx, cy
         else:
-            # Perform LOWESS on the valid points
-            lowess_x = lowess(valid_cx, valid_data_idx, frac=frac_val, return_sorted=True)
-            lowess_y = lowess(valid_cy, valid_data_idx, frac=frac_val, return_sorted=True)
-
             # We want to fill *every* integer data_index from min to max.
             min_idx, max_idx = data_idx.min(), data_idx.max()
             all_idx = np.arange(min_idx, max_idx + 1)
 
-            # Interpolate the LOWESS results at each integer data_index
-            smoothed_x = np.interp(all_idx, lowess_x[:, 0], lowess_x[:, 1])
-            smoothed_y = np.interp(all_idx, lowess_y[:, 0], lowess_y[:, 1])
+            # Perform LOWESS on the valid points (already sorted and NaN-free) and
+            # interpolate the results at each integer data_index. Large inputs use
+            # the Numba kernel (both coordinates in one pass) unless it is switched off.
+            # Fits closer together than 1% of the index range are interpolated (R's default delta).
+            # The last fit is cached, so changing only the shifts does not refit.
+            key = (input_csv, os.path.getmtime(input_csv), frac_val, use_numba_widget.value)
+            if key in _lowess_cache:
+                lowess_x, lowess_y = _lowess_cache[key]
+            else:
+                delta = 0.01 * (valid_data_idx[-1] - valid_data_idx[0])
+                lowess_x, lowess_y = lowess_grid_xy(valid_cx, valid_cy, valid_data_idx, all_idx, frac_val,
+                                                    use_numba=use_numba_widget.value, delta=delta)
+                _lowess_cache.clear()
+                _lowess_cache[key] = (lowess_x, lowess_y)
 
-            # Apply user shifts
-            smoothed_x += shift_x
-            smoothed_y += shift_y
+            # Apply user shifts (new arrays, so the cached fit stays unshifted)
+            smoothed_x = lowess_x + shift_x
+            smoothed_y = lowess_y + shift_y
 
-            # Create a new DataFrame that has *one row per integer data_index*:
-            df_smoothed = pd.DataFrame({
-                "data_index": all_idx,
-                "center_x": smoothed_x,
-                "center_y": smoothed_y
-            })
+            # The output has *one row per integer data_index*:
+            out_idx, out_cx, out_cy = all_idx, smoothed_x, smoothed_y
 
         # ---------------------------
-        # Plot old vs. new data
-        fig, axs = plt.subplots(1, 2, figsize=(12, 5))
-
-        # Original valid data
-        axs[0].plot(valid_data_idx, valid_cx, 'o--', label='Original X (valid)', markersize=4)
-        axs[1].plot(valid_data_idx, valid_cy, 'o--', label='Original Y (valid)', markersize=4)
-
-        # Full-range smoothed data
-        axs[0].plot(df_smoothed["data_index"], df_smoothed["center_x"], 'o-', label='Smoothed X (full)', markersize=4)
-        axs[1].plot(df_smoothed["data_index"], df_smoothed["center_y"], 'o-', label='Smoothed Y (full)', markersize=4)
-
-        axs[0].set_title("Center X vs. data_index")
-        axs[1].set_title("Center Y vs. data_index")
-        axs[0].legend()
-        axs[1].legend()
-        plt.show()
+        # Plot old vs. new data (optional; large series are thinned and rasterized)
+        if show_plot_widget.value:
+            fig, axs = plt.subplots(1, 2, figsize=(12, 5))
+
+            # Original valid data
+            stride = max(1, len(valid_data_idx) // MAX_PLOT_POINTS)
+            axs[0].plot(valid_data_idx[::stride], valid_cx[::stride], 'o--', label='Original X (valid)', markersize=4, rasterized=True)
+            axs[1].plot(valid_data_idx[::stride], valid_cy[::stride], 'o--', label='Original Y (valid)', markersize=4, rasterized=True)
+
+            # Full-range smoothed data
+            stride = max(1, len(out_idx) // MAX_PLOT_POINTS)
+            axs[0].plot(out_idx[::stride], out_cx[::stride], 'o-', label='Smoothed X (full)', markersize=4, rasterized=True)
+            axs[1].plot(out_idx[::stride], out_cy[::stride], 'o-', label='Smoothed Y (full)', markersize=4, rasterized=True)
+
+            axs[0].set_title("Center X vs. data_index")
+            axs[1].set_title("Center Y vs. data_index")
+            axs[0].legend()
+            axs[1].legend()
+            plt.show()
         # ---------------------------
 
         # Save the smoothed CSV
@@ -130,7 +156,11 @@ def on_process_csv_clicked(b):
             os.path.dirname(input_csv),
             f"{base_name}_lowess_{frac_val:.2f}_shifted_{shift_x}_{shift_y}.csv"
         )
-        df_smoothed.to_csv(out_path, index=False)
+        columns = {"data_index": out_idx, "center_x": out_cx, "center_y": out_cy}
+        if pa is not None:
+            pa_csv.write_csv(pa.table(columns), out_path)
+        else:
+            pd.DataFrame(columns).to_csv(out_path, index=False)
         _shifted_csv_path[0] = out_path
         print(f"Smoothed CSV saved:\n{out_path}")
 
@@ -141,6 +171,7 @@ lowess_ui = widgets.VBox([
     csv_file_chooser,
     widgets.HBox([shift_x_widget, shift_y_widget]),
     lowess_frac_widget,
+    widgets.HBox([use_numba_widget, show_plot_widget]),
     process_csv_button,
     csv_output
 ])
@@ -155,6 +186,7 @@ update_h5_button = widgets.Button(description="Update H5 with Smoothed Centers",
 h5_output = widgets.Output(layout={'border': '1px solid black', 'padding': '5px'})
 
 with_pb=widgets.Checkbox(value=False,description='Enable Progress Bar' )
+link_images_widget = widgets.Checkbox(value=False, description='Link images instead of copying them')
 
 def on_update_h5_clicked(b):
     with h5_output:
@@ -178,7 +210,12 @@ def on_update_h5_clicked(b):
         new_h5_path = os.path.join(subfolder_path, base_name + '.h5')
 
         try:
-            if with_pb.value:
+            if link_images_widget.value:
+                # No bulk copy, so no progress bar is needed.
+                create_updated_h5(image_file, new_h5_path, _shifted_csv_path[0], link_images=True)
+                print(f"Updated H5 file created at:\n{new_h5_path}")
+                print("Note: the images are linked from the original file, which must stay in place.")
+            elif with_pb.value:
                 create_updated_h5_pb(image_file, new_h5_path, _shifted_csv_path[0])
                 print(f"Updated H5 file created at:\n{new_h5_path}")
             else:
@@ -193,6 +230,7 @@ h5_ui = widgets.VBox([
     widgets.HTML("<h2>Section 2B: Update H5</h2>"),
     image_file_chooser_h5,
     with_pb,  # Include the progress bar checkbox here.
+    link_images_widget,
     update_h5_button,
     h5_output
 ])
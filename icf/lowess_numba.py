@@ -0,0 +1,195 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+import numpy as np
+import numba
+from statsmodels.nonparametric.smoothers_lowess import lowess
+
+# Below this many points statsmodels is fast enough and the JIT compile
+# (or, once it is cached, loading the compiled kernel, ~0.15 s) would cost
+# more than it saves.
+NUMBA_MIN_POINTS = 2000
+
+# From this many points the two statsmodels fits of lowess_sorted_xy take long
+# enough (~0.3 s each at frac=0.1) to be worth running in two processes.
+PARALLEL_MIN_POINTS = 5000
+
+# cache=True keeps the compiled kernel on disk, so only the very first run
+# pays the ~2 s compile, not every new GUI session.
+# parallel=True starts Numba's (TBB) worker threads in the GUI process itself;
+# a fork() after that leaves the process hanging at exit, so every child process
+# the GUIs start later (HDF5 copy, statsmodels fits, center finding) comes from
+# a forkserver context instead.
+@numba.njit(parallel=True, cache=True)
+def _lowess_pass(x, y, resid_weights, k, fit_idx):
+    """
+    One local-linear LOWESS pass over sorted x, evaluated at x[i] for every i in
+    fit_idx, for each column (channel) of y. Follows the statsmodels implementation (k-nearest
+    neighborhood, tricube weights times residual weights, closed-form weighted
+    linear fit), but every point is fitted independently so the loop runs in
+    parallel. The neighborhood and tricube weights are shared by all channels;
+    only the residual weights and the sums are per channel.
+    """
+    n = x.shape[0]
+    n_ch = y.shape[1]
+    y_fit = np.empty((fit_idx.shape[0], n_ch), dtype=np.float64)
+    for a in numba.prange(fit_idx.shape[0]):
+        i = fit_idx[a]
+        xval = x[i]
+
+        # 1) Neighborhood: the first window [left, left + k) whose midpoint
+        #    is not left of xval. The midpoints are increasing, so bisect.
+        lo = 0
+        hi = n - k
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if xval > (x[mid] + x[mid + k]) / 2.0:
+                lo = mid + 1
+            else:
+                hi = mid
+        left = lo
+        right = lo + k
+        radius = max(xval - x[left], x[right - 1] - xval)
+
+        # 2) Tricube weights times residual weights, accumulated straight into
+        #    the sums of the weighted linear fit (x taken relative to xval).
+        sw = np.zeros(n_ch)
+        swu = np.zeros(n_ch)
+        swuu = np.zeros(n_ch)
+        swy = np.zeros(n_ch)
+        swuy = np.zeros(n_ch)
+        n_nonzero = np.zeros(n_ch, dtype=np.int64)
+        if radius > 0.0:
+            for j in range(left, right):
+                u = x[j] - xval
+                d = abs(u) / radius
+                t = 1.0 - d * d * d
+                t = t * t * t
+                for c in range(n_ch):
+                    w = t * resid_weights[j, c]
+                    if w > 1e-12:
+                        n_nonzero[c] += 1
+                    sw[c] += w
+                    swu[c] += w * u
+                    swuu[c] += w * u * u
+                    swy[c] += w * y[j, c]
+                    swuy[c] += w * u * y[j, c]
+
+        # 3) Weighted linear regression evaluated at xval (u = 0).
+        for c in range(n_ch):
+            if n_nonzero[c] < 2:
+                y_fit[a, c] = y[i, c]
+                continue
+            mean_u = swu[c] / sw[c]
+            mean_y = swy[c] / sw[c]
+            sqdev_u = max(swuu[c] / sw[c] - mean_u * mean_u, 1e-12)
+            y_fit[a, c] = mean_y - mean_u * (swuy[c] / sw[c] - mean_u * mean_y) / sqdev_u
+    return y_fit
+
+@numba.njit(cache=True)
+def _fit_indices(x, delta):
+    """
+    Indices of sorted x at which LOWESS is evaluated for a given delta, as in
+    statsmodels: after a fit at x[i], the next fit is at the last point within
+    delta of x[i], but always at a larger x. delta=0 fits every distinct x.
+    """
+    n = x.shape[0]
+    idx = np.empty(n, dtype=np.int64)
+    idx[0] = 0
+    m = 1
+    i = 0
+    while i < n - 1:
+        # First point beyond delta; statsmodels stops its scan at the last point.
+        k = min(np.searchsorted(x, x[i] + delta, side='right'), n - 1)
+        i = max(np.searchsorted(x, x[i], side='right'), k - 1)
+        if i >= n:
+            break
+        idx[m] = i
+        m += 1
+    return idx[:m]
+
+def _residual_weights(y, y_fit):
+    """
+    Bisquare robustness weights, as in statsmodels (one column per channel).
+    """
+    std_resid = np.abs(y - y_fit)
+    for c in range(std_resid.shape[1]):
+        median = np.median(std_resid[:, c])
+        if median == 0:
+            std_resid[:, c] = std_resid[:, c] > 0
+        else:
+            std_resid[:, c] /= 6.0 * median
+    np.minimum(std_resid, 1.0, out=std_resid)
+    return (1.0 - std_resid ** 2) ** 2
+
+def lowess_numba(y, x, frac, it=3, delta=0.0):
+    """
+    Numba LOWESS of y against x. x must be sorted and free of NaNs. y may be 1-D,
+    or 2-D with one column per channel smoothed against the same x.
+    With delta > 0, only points spaced about delta apart are fitted and the rest
+    are linearly interpolated, as statsmodels' delta does.
+    Returns the fitted values in input order, with the shape of y.
+    """
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    y2d = np.ascontiguousarray(y.reshape(len(x), -1))
+    n = x.shape[0]
+    k = min(max(int(frac * n + 1e-10), 2), n)
+
+    fit_idx = _fit_indices(x, delta) if n else np.arange(0)
+    resid_weights = np.ones_like(y2d)
+    for robiter in range(it + 1):
+        y_fit = _lowess_pass(x, y2d, resid_weights, k, fit_idx)
+        if len(fit_idx) < n:
+            x_fit = x[fit_idx]
+            y_fit = np.column_stack([np.interp(x, x_fit, y_fit[:, c]) for c in range(y2d.shape[1])])
+        if robiter < it:
+            resid_weights = _residual_weights(y2d, y_fit)
+    return y_fit.reshape(y.shape)
+
+def lowess_sorted(y, x, frac, it=3, use_numba=True, delta=0.0):
+    """
+    LOWESS of y against sorted, NaN-free x. Returns the fitted values in input
+    order. Large inputs go through the Numba kernel when use_numba is set,
+    everything else through statsmodels. delta is statsmodels' delta: fits closer
+    than delta apart are replaced by linear interpolation.
+    """
+    if use_numba and len(x) >= NUMBA_MIN_POINTS:
+        return lowess_numba(y, x, frac, it=it, delta=delta)
+    return lowess(y, x, frac=frac, it=it, delta=delta,
+                  is_sorted=True, missing='none', return_sorted=False)
+
+def lowess_sorted_xy(cx, cy, x, frac, it=3, use_numba=True, delta=0.0):
+    """
+    LOWESS of both center coordinates against the same sorted, NaN-free x.
+    The Numba path fits both in one pass that shares the neighborhoods. Without
+    Numba, large inputs are fitted in two processes (statsmodels holds the GIL,
+    so threads would not run the fits concurrently).
+    Returns (fit_x, fit_y) in input order.
+    """
+    if use_numba and len(x) >= NUMBA_MIN_POINTS:
+        fit = lowess_numba(np.column_stack((cx, cy)), x, frac, it=it, delta=delta)
+        return fit[:, 0], fit[:, 1]
+    if len(x) >= PARALLEL_MIN_POINTS and (os.cpu_count() or 1) > 1:
+        kwargs = dict(frac=frac, it=it, delta=delta, is_sorted=True, missing='none', return_sorted=False)
+        # Not forked: after an earlier Numba fit the TBB worker threads of _lowess_pass
+        # would leave this process hanging at exit.
+        ctx = get_context("forkserver" if "forkserver" in get_all_start_methods() else None)
+        with ProcessPoolExecutor(2, mp_context=ctx) as ex:
+            fx = ex.submit(lowess, cx, x, **kwargs)
+            fy = ex.submit(lowess, cy, x, **kwargs)
+            return fx.result(), fy.result()
+    return (lowess_sorted(cx, x, frac, it=it, use_numba=False, delta=delta),
+            lowess_sorted(cy, x, frac, it=it, use_numba=False, delta=delta))
+
+def lowess_grid_xy(cx, cy, x, grid, frac, it=3, use_numba=True, delta=0.0):
+    """
+    LOWESS of both center coordinates against sorted, NaN-free x, returned on the
+    sorted grid (every integer data_index). The fits are linearly interpolated onto
+    the grid, unless x already is the grid (every frame has a center), in which
+    case the fitted values are returned as they are.
+    """
+    fit_x, fit_y = lowess_sorted_xy(cx, cy, x, frac, it=it, use_numba=use_numba, delta=delta)
+    if np.array_equal(x, grid):
+        return fit_x, fit_y
+    return np.interp(grid, x, fit_x), np.interp(grid, x, fit_y)
@@ -1,8 +1,51 @@
 #!/usr/bin/env python3
+import os
+import shutil
 import h5py
+import numpy as np
 import pandas as pd
 
-def create_updated_h5(original_h5_path, new_h5_path, csv_path, framesize=1024, pixels_per_meter=17857.14285714286):
+# Chunk cache for reading the original file. The 1 MiB default is smaller than a single
+# chunk of a large index dataset, which then bypasses the cache and is decompressed
+# again on every access.
+SRC_CACHE_NBYTES = 64 * 1024 * 1024
+SRC_CACHE_NSLOTS = 100003
+
+def copy_entry_with_linked_images(src, dst, original_h5_path):
+    """
+    Copy the 'entry' group of src into dst, except 'entry/data/images', which becomes
+    an external link to the original file instead of a copy of the image data.
+    Every other child of 'entry' and 'entry/data' is copied as a whole subtree
+    (data, attributes and links) with a single native copy.
+    """
+    entry = dst.require_group('entry')
+    entry.attrs.update(src['entry'].attrs)
+    for name in src['entry']:
+        if name != 'data':
+            dst.copy(src['entry'][name], 'entry/' + name)
+    data = entry.require_group('data')
+    data.attrs.update(src['entry/data'].attrs)
+    for name in src['entry/data']:
+        if name == 'images':
+            data[name] = h5py.ExternalLink(os.path.abspath(original_h5_path), 'entry/data/images')
+        else:
+            dst.copy(src['entry/data'][name], 'entry/data/' + name)
+
+def write_frame_dataset(dst, name, data):
+    """
+    Create the per-frame float64 dataset name in dst and write data straight into it.
+    The dataset is chunked and compressed (byte shuffle + gzip level 1, which every
+    HDF5 reader, CrystFEL included, can decode).
+    """
+    data = np.ascontiguousarray(data, dtype=np.float64)
+    dset = dst.create_dataset(name, shape=data.shape, dtype='float64',
+                              chunks=(max(1, min(len(data), 65536)),),
+                              shuffle=True, compression='gzip', compression_opts=1)
+    if len(data):
+        dset.write_direct(data)
+
+def create_updated_h5(original_h5_path, new_h5_path, csv_path, framesize=1024, pixels_per_meter=17857.14285714286,
+                      link_images=False):
     """
     Create a new HDF5 file by copying the original file's structure,
     update the center_x and center_y datasets using CSV data (only for rows
@@ -22,6 +65,13 @@ def create_updated_h5(original_h5_path, new_h5_path, csv_path, framesize=1024, p
         Size of the frame (assumed square) used for recalculating shifts (default is 1024).
     pixels_per_meter : float, optional
         Conversion factor from pixels to meters (default is 17857.14285714286).
+    link_images : bool, optional
+        If True, 'entry/data/images' is not copied but stored as an external link to
+        the original file, so the new file is created almost instantly. The new file
+        then needs the original file to stay in place (default is False).
+        Otherwise, when 'entry' is the only top-level object of the original file, the
+        file is copied as a whole at the OS level (no HDF5 object traversal), which is
+        much faster and can be a near-instant reflink on copy-on-write filesystems.
     """
     # 1. Read CSV data and ensure required columns exist
     df = pd.read_csv(csv_path)
@@ -30,25 +80,61 @@ def create_updated_h5(original_h5_path, new_h5_path, csv_path, framesize=1024, p
         raise ValueError(f"CSV file must contain columns: {required_cols}")
 
     # 2. Open the original HDF5 file and read the 'entry/data/index' dataset
-    with h5py.File(original_h5_path, 'r') as src:
+    with h5py.File(original_h5_path, 'r', rdcc_nbytes=SRC_CACHE_NBYTES, rdcc_nslots=SRC_CACHE_NSLOTS) as src:
         h5_index = src['entry/data/index'][()]
 
-    # 3. Filter CSV to keep only rows with matching data_index, and reindex
-    df_filtered = df[df['data_index'].isin(h5_index)].copy()
-    # Set data_index as the index for alignment
-    df_filtered.set_index('data_index', inplace=True)
-    # Reorder rows to match the order in the HDF5 file
-    df_filtered = df_filtered.reindex(h5_index)
-    if df_filtered.isnull().values.any():
-        raise ValueError("Not all indices in the HDF5 file were found in the CSV file.")
+    # 3. Look up the centers for every entry of the HDF5 index.
+    data_index = df['data_index'].to_numpy()
+    min_idx = data_index[0] if len(data_index) else 0
+    integral = (np.issubdtype(data_index.dtype, np.integer)
+                and np.issubdtype(h5_index.dtype, np.integer))
+    if (integral and len(data_index)
+            and np.array_equal(data_index, np.arange(min_idx, min_idx + len(data_index)))):
+        # Smoothed CSVs hold one row per integer data_index from min to max, so the
+        # row of each HDF5 entry is simply its offset from the first data_index.
+        # Taken in int64: a uint64 index minus an int64 would promote to float64.
+        pos = h5_index.astype(np.int64, copy=False) - int(min_idx)
+        if ((pos < 0) | (pos >= len(data_index))).any():
+            raise ValueError("Not all indices in the HDF5 file were found in the CSV file.")
+        center_x = df['center_x'].to_numpy()[pos]
+        center_y = df['center_y'].to_numpy()[pos]
+    else:
+        # Otherwise (or for float indices) sort the CSV by data_index once and
+        # binary-search every HDF5 entry.
+        order = np.argsort(data_index, kind='stable')
+        sorted_index = data_index[order]
+        pos = np.searchsorted(sorted_index, h5_index)
+        found = pos < len(sorted_index)
+        found[found] = sorted_index[pos[found]] == h5_index[found]
+        if not found.all():
+            raise ValueError("Not all indices in the HDF5 file were found in the CSV file.")
+        nxt = pos + 1
+        has_next = nxt < len(sorted_index)
+        if (sorted_index[nxt[has_next]] == h5_index[has_next]).any():
+            raise ValueError("The CSV file contains duplicate data_index values.")
 
-    # Extract centers in the order of the HDF5 index
-    center_x = df_filtered['center_x'].values
-    center_y = df_filtered['center_y'].values
+        # Extract centers in the order of the HDF5 index
+        rows = order[pos]
+        center_x = df['center_x'].to_numpy()[rows]
+        center_y = df['center_y'].to_numpy()[rows]
 
-    # 4. Copy the original HDF5 file structure into a new file
-    with h5py.File(original_h5_path, 'r') as src, h5py.File(new_h5_path, 'w') as dst:
-        src.copy('entry', dst)
+    # A NaN center means the row for that frame was found but left empty, so the
+    # frame has no center either; checked on the two gathered arrays only.
+    if np.isnan(center_x).any() or np.isnan(center_y).any():
+        raise ValueError("Not all indices in the HDF5 file were found in the CSV file.")
+
+    # 4. Copy the original HDF5 file structure into a new file (optionally linking the images)
+    with h5py.File(original_h5_path, 'r') as src:
+        entry_only = list(src.keys()) == ['entry']
+    if entry_only and not link_images:
+        shutil.copyfile(original_h5_path, new_h5_path)
+    else:
+        with h5py.File(original_h5_path, 'r', rdcc_nbytes=SRC_CACHE_NBYTES, rdcc_nslots=SRC_CACHE_NSLOTS) as src, \
+             h5py.File(new_h5_path, 'w') as dst:
+            if link_images:
+                copy_entry_with_linked_images(src, dst, original_h5_path)
+            else:
+                src.copy('entry', dst)
 
     # 5. Reopen the new file in read-write mode to update datasets
     with h5py.File(new_h5_path, 'r+') as dst:
@@ -56,20 +142,26 @@ def create_updated_h5(original_h5_path, new_h5_path, csv_path, framesize=1024, p
         for dset in ['entry/data/center_x', 'entry/data/center_y']:
             if dset in dst:
                 del dst[dset]
-        dst.create_dataset('entry/data/center_x', data=center_x, dtype='float64')
-        dst.create_dataset('entry/data/center_y', data=center_y, dtype='float64')
+        write_frame_dataset(dst, 'entry/data/center_x', center_x)
+        write_frame_dataset(dst, 'entry/data/center_y', center_y)
 
         # 6. Compute the new detector shifts
         presumed_center = framesize / 2.0
-        det_shift_x_mm = -((center_x - presumed_center) / pixels_per_meter) * 1000
-        det_shift_y_mm = -((center_y - presumed_center) / pixels_per_meter) * 1000
+        # -((c - presumed_center) / pixels_per_meter) * 1000, computed in place in one buffer
+        # per axis (same operation order, so the values are bit-identical).
+        det_shift_x_mm = np.subtract(center_x, presumed_center)
+        det_shift_x_mm /= pixels_per_meter
+        det_shift_x_mm *= -1000
+        det_shift_y_mm = np.subtract(center_y, presumed_center)
+        det_shift_y_mm /= pixels_per_meter
+        det_shift_y_mm *= -1000
 
         # Remove and recreate detector shift datasets
         for dset in ['entry/data/det_shift_x_mm', 'entry/data/det_shift_y_mm']:
             if dset in dst:
                 del dst[dset]
-        dst.create_dataset('entry/data/det_shift_x_mm', data=det_shift_x_mm, dtype='float64')
-        dst.create_dataset('entry/data/det_shift_y_mm', data=det_shift_y_mm, dtype='float64')
+        write_frame_dataset(dst, 'entry/data/det_shift_x_mm', det_shift_x_mm)
+        write_frame_dataset(dst, 'entry/data/det_shift_y_mm', det_shift_y_mm)
 
     print(f"New HDF5 file created: {new_h5_path}")
     print("Center coordinates and detector shifts have been updated.")
@@ -1,50 +1,153 @@
 #!/usr/bin/env python3
 import h5py
+import numpy as np
 import pandas as pd
 import os
-import time
-import threading
 import logging
 from tqdm import tqdm
+from multiprocessing import Process, get_all_start_methods, get_context
 from typing import Any
 
+# Blosc filters for compression='blosc'; optional, since files written with them can
+# only be read where the Blosc HDF5 plugin is available too.
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-def monitor_progress(original_h5_path: str, new_h5_path: str, progress_bar: tqdm, stop_event: threading.Event) -> None:
+# Chunk cache for reading the original file. The 1 MiB default is smaller than a single
+# chunk of a large index dataset, which then bypasses the cache and is decompressed
+# again on every access.
+SRC_CACHE_NBYTES = 64 * 1024 * 1024
+SRC_CACHE_NSLOTS = 100003
+
+def copy_h5_entry(src: h5py.File, dst: h5py.File) -> None:
     """
-    Monitor the progress of the HDF5 file copy by checking the new file's size.
+    Copy the entire 'entry' group from the source file to the destination file
+    using h5py.File.copy. HDF5 copies chunked datasets chunk by chunk as stored
+    (still compressed), so memory use stays at about one chunk whatever the size
+    of the images, and nothing is decompressed or recompressed.
     
     Parameters:
-        original_h5_path (str): Path to the original HDF5 file.
-        new_h5_path (str): Path to the new HDF5 file.
-        progress_bar (tqdm): A tqdm progress bar instance.
-        stop_event (threading.Event): An event to signal when to stop monitoring.
+        src (h5py.File): Source HDF5 file.
+        dst (h5py.File): Destination HDF5 file.
     """
-    try:
-        while not stop_event.is_set():
-            try:
-                new_size = os.path.getsize(new_h5_path)
-            except Exception:
-                new_size = 0
-            progress_bar.n = new_size
-            progress_bar.refresh()
-            time.sleep(1)
-    finally:
-        # Ensure the progress bar is fully updated at the end.
-        progress_bar.n = progress_bar.total
-        progress_bar.refresh()
+    dst.copy(src["entry"], "entry")
 
-def copy_h5_entry(src: h5py.File, dst: h5py.File) -> None:
+# Datasets that create_updated_h5_pb writes itself; everything else in an overlay file is linked.
+UPDATED_DATASETS = ('center_x', 'center_y', 'det_shift_x_mm', 'det_shift_y_mm')
+
+def create_overlay_entry(src: h5py.File, dst: h5py.File, original_h5_path: str) -> None:
     """
-    Copy the entire 'entry' group from the source file to the destination file
-    using h5py.File.copy.
+    Build an 'entry' group in dst in which every object of the original file is an
+    external link to it, except the updated datasets under 'entry/data', which the
+    caller writes as local datasets. Nothing else is copied.
     
     Parameters:
         src (h5py.File): Source HDF5 file.
         dst (h5py.File): Destination HDF5 file.
+        original_h5_path (str): Path of the source file, stored (absolute) in the links.
     """
-    dst.copy(src["entry"], "entry")
+    target = os.path.abspath(original_h5_path)
+    entry = dst.create_group("entry")
+    entry.attrs.update(src["entry"].attrs)
+    for name in src["entry"]:
+        if name != "data":
+            entry[name] = h5py.ExternalLink(target, f"/entry/{name}")
+    data = entry.create_group("data")
+    data.attrs.update(src["entry/data"].attrs)
+    for name in src["entry/data"]:
+        if name not in UPDATED_DATASETS:
+            data[name] = h5py.ExternalLink(target, f"/entry/data/{name}")
+
+def process_copy_h5_entry(original_h5_path: str, new_h5_path: str) -> None:
+    """
+    Open both files and copy the 'entry' group. This function is meant to be run in
+    a separate process, since the copy holds the GIL for its whole duration.
+    
+    Parameters:
+        original_h5_path (str): Path to the original HDF5 file.
+        new_h5_path (str): Path where the new HDF5 file will be created.
+    """
+    with h5py.File(original_h5_path, 'r', rdcc_nbytes=SRC_CACHE_NBYTES, rdcc_nslots=SRC_CACHE_NSLOTS) as src, \
+         h5py.File(new_h5_path, 'w') as dst:
+        copy_h5_entry(src, dst)
+
+def wait_for_copy(copy_process: Process, new_h5_path: str, pbar: tqdm, interval: float = 0.5) -> None:
+    """
+    Wait for the copy process to exit, advancing the progress bar to the size of the
+    new file in between. The wait returns as soon as the process exits, not at the
+    next poll.
+    
+    Parameters:
+        copy_process (Process): The running copy process.
+        new_h5_path (str): Path of the file being written.
+        pbar (tqdm): Progress bar counting bytes.
+        interval (float): Seconds between file size checks.
+    """
+    while copy_process.is_alive():
+        try:
+            new_size = os.path.getsize(new_h5_path)
+        except OSError:
+            new_size = 0
+        if new_size > pbar.n:
+            # update() rather than setting n, so tqdm's rate estimate stays correct.
+            pbar.update(new_size - pbar.n)
+        copy_process.join(timeout=interval)
+
+def write_frame_dataset(dst: h5py.File, name: str, data: Any, compression: str = "gzip") -> None:
+    """
+    Create the per-frame float64 dataset name in dst and write data straight into it.
+    The dataset is chunked and compressed: by default with byte shuffle + gzip level 1,
+    which every HDF5 reader, CrystFEL included, can decode; with compression='blosc'
+    with Blosc LZ4 + bitshuffle (needs hdf5plugin, also for reading the file).
+    
+    Parameters:
+        dst (h5py.File): Destination HDF5 file.
+        name (str): Path of the dataset.
+        data (array-like): 1-D values, one per frame.
+        compression (str): 'gzip' or 'blosc'.
+    """
+    if compression == "blosc":
+        filter_kwargs = dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.BITSHUFFLE))
+    else:
+        filter_kwargs = dict(shuffle=True, compression='gzip', compression_opts=1)
+    data = np.ascontiguousarray(data, dtype=np.float64)
+    dset = dst.create_dataset(name, shape=data.shape, dtype='float64',
+                              chunks=(max(1, min(len(data), 65536)),), **filter_kwargs)
+    if len(data):
+        dset.write_direct(data)
+
+def read_centers_csv(csv_path: str) -> pd.DataFrame:
+    """
+    Read a centers CSV with pandas' multithreaded pyarrow parser, or with the default
+    parser when pyarrow is not installed; a .parquet path is read as Parquet. Only the
+    given file is ever read.
+    
+    Parameters:
+        csv_path (str): Path to the CSV (or Parquet) file.
+    """
+    if csv_path.endswith('.parquet'):
+        return pd.read_parquet(csv_path)
+    try:
+        return pd.read_csv(csv_path, engine='pyarrow')
+    except ImportError:
+        return pd.read_csv(csv_path)
+
+def fits_int32(values: np.ndarray) -> bool:
+    """
+    Whether values is an integer array whose values all fit in int32.
+    
+    Parameters:
+        values (np.ndarray): Array to check.
+    """
+    if values.dtype.kind not in 'iu':
+        return False
+    info = np.iinfo(np.int32)
+    return values.size == 0 or (values.min() >= info.min and values.max() <= info.max)
 
 def create_updated_h5_pb(
     original_h5_path: str,
@@ -52,7 +155,9 @@ def create_updated_h5_pb(
     csv_path: str,
     use_progress: bool = True,
     framesize: int = 1024,
-    pixels_per_meter: float = 17857.14285714286
+    pixels_per_meter: float = 17857.14285714286,
+    mode: str = "copy",
+    compression: str = "gzip"
 ) -> None:
     """
     Create a new HDF5 file by copying the original file's structure,
@@ -65,15 +170,26 @@ def create_updated_h5_pb(
         use_progress (bool): Whether to display a progress bar during the copy.
         framesize (int): Frame size used for recalculating shifts.
         pixels_per_meter (float): Conversion factor from pixels to meters.
+        mode (str): 'copy' copies the 'entry' group into the new file. 'overlay' only
+            writes the updated datasets and links everything else to the original file,
+            which is near-instant but needs the original file to stay in place.
+        compression (str): Filter for the updated datasets: 'gzip' (readable everywhere) or
+            'blosc' (Blosc LZ4, needs hdf5plugin to write and to read the file).
     """
     # Overwrite protection: do not overwrite an existing file.
     if os.path.exists(new_h5_path):
         logging.error(f"File {new_h5_path} already exists. Exiting to avoid overwrite.")
         raise FileExistsError(f"File {new_h5_path} already exists.")
+    if mode not in ("copy", "overlay"):
+        raise ValueError(f"mode must be 'copy' or 'overlay', not {mode!r}.")
+    if compression not in ("gzip", "blosc"):
+        raise ValueError(f"compression must be 'gzip' or 'blosc', not {compression!r}.")
+    if compression == "blosc" and hdf5plugin is None:
+        raise ImportError("compression='blosc' needs the hdf5plugin package.")
 
     # 1. Read CSV data and validate required columns.
     try:
-        df: pd.DataFrame = pd.read_csv(csv_path)
+        df: pd.DataFrame = read_centers_csv(csv_path)
     except Exception as e:
         logging.exception("Failed to read CSV file.")
         raise e
@@ -81,53 +197,77 @@ def create_updated_h5_pb(
     if not all(col in df.columns for col in required_cols):
         raise ValueError(f"CSV file must contain columns: {required_cols}")
 
-    # 2. Retrieve the HDF5 index from the original file.
+    # 2. Open the original file once and retrieve the HDF5 index; the same handle is
+    #    used for the copy below.
+    src = None
     try:
-        with h5py.File(original_h5_path, 'r') as src:
-            h5_index = src['entry/data/index'][()]
+        src = h5py.File(original_h5_path, 'r', rdcc_nbytes=SRC_CACHE_NBYTES, rdcc_nslots=SRC_CACHE_NSLOTS)
+        h5_index = src['entry/data/index'][()]
     except Exception as e:
+        if src is not None:
+            src.close()
         logging.exception("Failed to open original HDF5 file or access 'entry/data/index'.")
         raise e
 
-    # 3. Filter CSV data based on the HDF5 index.
-    df_filtered: pd.DataFrame = df[df['data_index'].isin(h5_index)].copy()
-    df_filtered.set_index('data_index', inplace=True)
-    df_filtered = df_filtered.reindex(h5_index)
-    if df_filtered.isnull().values.any():
-        raise ValueError("Not all indices in the HDF5 file were found in the CSV file.")
-
-    center_x = df_filtered['center_x'].values
-    center_y = df_filtered['center_y'].values
+    with src:
+        # 3. Look up the CSV row of every HDF5 index entry with one hash lookup on data_index
+        #    and gather the centers from the raw arrays. Rows that are not in the HDF5 index
+        #    are ignored; they only need filtering out first when data_index has duplicates.
+        #    The lookup runs on int32 keys when both indices fit, which halves the memory
+        #    it hashes and scans (it only pays off when both sides have the same dtype).
+        csv_index = df['data_index'].to_numpy()
+        if fits_int32(csv_index) and fits_int32(h5_index):
+            csv_index = csv_index.astype(np.int32)
+            h5_index = h5_index.astype(np.int32)
+        data_index = pd.Index(csv_index)
+        center_x = df['center_x'].to_numpy()
+        center_y = df['center_y'].to_numpy()
+        if not data_index.is_unique:
+            keep = data_index.isin(h5_index)
+            data_index, center_x, center_y = data_index[keep], center_x[keep], center_y[keep]
+            if not data_index.is_unique:
+                raise ValueError("The CSV file contains duplicate data_index values.")
+        rows = data_index.get_indexer(h5_index)
+        if (rows == -1).any():
+            raise ValueError("Not all indices in the HDF5 file were found in the CSV file.")
+        center_x = center_x[rows]
+        center_y = center_y[rows]
+        if np.isnan(center_x).any() or np.isnan(center_y).any():
+            raise ValueError("Not all indices in the HDF5 file were found in the CSV file.")
 
-    # 4. Copy the original HDF5 file structure to a new file.
-    try:
-        if use_progress:
-            original_size = os.path.getsize(original_h5_path)
-            with h5py.File(original_h5_path, 'r') as src, h5py.File(new_h5_path, 'w') as dst:
+        # 4. Copy (or, in overlay mode, link) the original HDF5 file structure to a new file.
+        #    With a progress bar the copy runs in a separate process (a thread next to it
+        #    would not get the GIL), and the new file's size is polled until it is done.
+        try:
+            if mode == "overlay":
+                # Only links are written, so there is nothing to show progress for.
+                with h5py.File(new_h5_path, 'w') as dst:
+                    create_overlay_entry(src, dst, original_h5_path)
+            elif use_progress:
+                # The copy process opens the file itself, so release this handle first.
+                src.close()
+                original_size = os.path.getsize(original_h5_path)
                 with tqdm(total=original_size, unit='B', unit_scale=True, unit_divisor=1024,
                           desc="Copying HDF5 file",
                           bar_format="{l_bar}{bar} {n_fmt}/{total_fmt} [{elapsed}<{remaining}]") as pbar:
-                    stop_event = threading.Event()
-                    monitor_thread = threading.Thread(
-                        target=monitor_progress,
-                        args=(original_h5_path, new_h5_path, pbar, stop_event)
-                    )
-                    monitor_thread.start()
-                    try:
-                        copy_h5_entry(src, dst)
-                    except Exception as e:
-                        logging.exception("Error during HDF5 file copy.")
-                        raise e
-                    finally:
-                        # Ensure thread cleanup.
-                        stop_event.set()
-                        monitor_thread.join()
-        else:
-            with h5py.File(original_h5_path, 'r') as src, h5py.File(new_h5_path, 'w') as dst:
-                copy_h5_entry(src, dst)
-    except Exception as e:
-        logging.exception("Failed to copy HDF5 file structure.")
-        raise e
+                    # Numba's TBB worker threads do not survive fork(): after a parallel kernel
+                    # (e.g. the LOWESS fit in the same notebook) a forked child leaves this process
+                    # hanging at exit, so the copy process is started from a forkserver where there is one.
+                    ctx = get_context("forkserver" if "forkserver" in get_all_start_methods() else None)
+                    copy_process = ctx.Process(target=process_copy_h5_entry, args=(original_h5_path, new_h5_path))
+                    copy_process.start()
+                    wait_for_copy(copy_process, new_h5_path, pbar)
+                    if copy_process.exitcode != 0:
+                        raise RuntimeError(f"HDF5 copy process failed with exit code {copy_process.exitcode}.")
+                    # Ensure the progress bar reaches 100%.
+                    pbar.n = original_size
+                    pbar.refresh()
+            else:
+                with h5py.File(new_h5_path, 'w') as dst:
+                    copy_h5_entry(src, dst)
+        except Exception as e:
+            logging.exception("Failed to copy HDF5 file structure.")
+            raise e
 
     # 5. Update center coordinates and detector shifts in the new file.
     try:
@@ -136,19 +276,25 @@ def create_updated_h5_pb(
             for dset in ['entry/data/center_x', 'entry/data/center_y']:
                 if dset in dst:
                     del dst[dset]
-            dst.create_dataset('entry/data/center_x', data=center_x, dtype='float64')
-            dst.create_dataset('entry/data/center_y', data=center_y, dtype='float64')
+            write_frame_dataset(dst, 'entry/data/center_x', center_x, compression)
+            write_frame_dataset(dst, 'entry/data/center_y', center_y, compression)
 
             # Recalculate detector shifts.
             presumed_center = framesize / 2.0
-            det_shift_x_mm = -((center_x - presumed_center) / pixels_per_meter) * 1000
-            det_shift_y_mm = -((center_y - presumed_center) / pixels_per_meter) * 1000
+            # -((c - presumed_center) / pixels_per_meter) * 1000, computed in place in one buffer
+            # per axis (same operation order, so the values are bit-identical).
+            det_shift_x_mm = np.subtract(center_x, presumed_center)
+            det_shift_x_mm /= pixels_per_meter
+            det_shift_x_mm *= -1000
+            det_shift_y_mm = np.subtract(center_y, presumed_center)
+            det_shift_y_mm /= pixels_per_meter
+            det_shift_y_mm *= -1000
 
             for dset in ['entry/data/det_shift_x_mm', 'entry/data/det_shift_y_mm']:
                 if dset in dst:
                     del dst[dset]
-            dst.create_dataset('entry/data/det_shift_x_mm', data=det_shift_x_mm, dtype='float64')
-            dst.create_dataset('entry/data/det_shift_y_mm', data=det_shift_y_mm, dtype='float64')
+            write_frame_dataset(dst, 'entry/data/det_shift_x_mm', det_shift_x_mm, compression)
+            write_frame_dataset(dst, 'entry/data/det_shift_y_mm', det_shift_y_mm, compression)
     except Exception as e:
         logging.exception("Failed to update center coordinates or detector shifts.")
         raise e
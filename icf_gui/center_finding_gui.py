@@ -8,6 +8,20 @@ from tkinter import filedialog, messagebox
 # Import your updated processing function.
 from image_processing import process_images_apply_async
 
+def read_mask(dset):
+    """
+    Reads a mask dataset into a boolean array (non-zero = valid pixel). One-byte masks
+    (bool, uint8, int8) are read straight into the output buffer and converted in
+    place, so no second full-size copy is made; other dtypes are read and converted.
+    """
+    if dset.dtype.itemsize == 1 and dset.dtype.kind in 'biu':
+        buf = np.empty(dset.shape, dtype=dset.dtype)
+        dset.read_direct(buf)
+        mask = buf.view(bool)
+        np.not_equal(buf, 0, out=mask)
+        return mask
+    return dset[()].astype(bool)
+
 def select_file(title, filetypes):
     """Helper to open a file dialog and return the selected file path."""
     return filedialog.askopenfilename(
@@ -27,7 +41,8 @@ def get_ui(parent):
     instructions = (
         "Select your H5 image file and a mask file, then set parameters to find the diffraction center.\n"
         "A CSV with the found centers will be created in the same folder as the selected image file.\n"
-        "Processing feedback will be printed to the terminal."
+        "Processing feedback will be printed to the terminal.\n"
+        "Tip: for stacks stored with many frames per chunk, run rechunk_images.py once to get one frame per chunk."
     )
     instruction_label = tk.Label(frame, text=instructions, justify=tk.LEFT)
     instruction_label.grid(row=0, column=0, columnspan=5, padx=10, pady=10, sticky='w')
@@ -117,11 +132,12 @@ def get_ui(parent):
         
         try:
             with h5py.File(mask_file, 'r') as f_mask:
+                dset = f_mask['/mask']
                 if use_mask_var.get():
-                    mask = f_mask['/mask'][:].astype(bool)
+                    mask = read_mask(dset)
                 else:
-                    sample = f_mask['/mask'][0]
-                    mask = np.ones_like(sample, dtype=bool)
+                    # Only the frame shape is needed, which comes from the metadata.
+                    mask = np.ones(dset.shape[-2:], dtype=bool)
         except Exception as e:
             print("Error loading mask file:", e)
             messagebox.showerror("Error", "Error loading mask file:\n" + str(e))
@@ -5,34 +5,40 @@ import matplotlib.pyplot as plt
 csv_file1 = "/home/bubl3932/files/UOX1/UOX1_original/centers_xatol_0.01_frameinterval_10_lowess_0.10_shifted_0.5_-0.3/xgandalf_iterations_max_radius_1.8_step_0.5/refined_centers.csv"   # contains: EventIndex, RefinedCenterX, RefinedCenterY
 csv_file2 = "/home/bubl3932/files/UOX1/centers_xatol_0.01_frameinterval_10_lowess_0.10_shifted_0.5_-0.3.csv"       # contains: data_index, center_x, center_y
 
-# Read the CSV files into DataFrames.
-df1 = pd.read_csv(csv_file1)
-df2 = pd.read_csv(csv_file2)
-
-# ----------------------------
-# Plot X coordinates vs. Index
-# ----------------------------
-plt.figure()
-plt.plot(df1["EventIndex"], df1["RefinedCenterX"], marker='o', linestyle='-', label="RefinedCenterX")
-plt.plot(df2["data_index"], df2["center_x"], marker='o', linestyle='-', label="center_x")
-plt.xlabel("Index")
-plt.ylabel("X Coordinate")
-plt.title("X Coordinate vs. Index")
-plt.legend()
-plt.grid(True)
-plt.tight_layout()
-plt.show()
+def read_columns(csv_file, columns):
+    """Reads only the given columns, with pandas' pyarrow parser when pyarrow is installed."""
+    try:
+        return pd.read_csv(csv_file, engine='pyarrow', usecols=columns)
+    except ImportError:
+        return pd.read_csv(csv_file, usecols=columns)
+
+# Read the needed columns of the CSV files into DataFrames.
+df1 = read_columns(csv_file1, ["EventIndex", "RefinedCenterX", "RefinedCenterY"])
+df2 = read_columns(csv_file2, ["data_index", "center_x", "center_y"])
+
+# Convert each column to a NumPy array once; both plots use them directly.
+index1 = df1["EventIndex"].to_numpy()
+index2 = df2["data_index"].to_numpy()
+
+# ----------------------------------------------------
+# Plot X and Y coordinates vs. Index in one figure
+# ----------------------------------------------------
+fig, (ax_x, ax_y) = plt.subplots(2, 1, sharex=True)
+
+ax_x.plot(index1, df1["RefinedCenterX"].to_numpy(), marker='o', linestyle='-', label="RefinedCenterX")
+ax_x.plot(index2, df2["center_x"].to_numpy(), marker='o', linestyle='-', label="center_x")
+ax_x.set_ylabel("X Coordinate")
+ax_x.set_title("X Coordinate vs. Index")
+ax_x.legend()
+ax_x.grid(True)
+
+ax_y.plot(index1, df1["RefinedCenterY"].to_numpy(), marker='o', linestyle='-', label="RefinedCenterY")
+ax_y.plot(index2, df2["center_y"].to_numpy(), marker='o', linestyle='-', label="center_y")
+ax_y.set_xlabel("Index")
+ax_y.set_ylabel("Y Coordinate")
+ax_y.set_title("Y Coordinate vs. Index")
+ax_y.legend()
+ax_y.grid(True)
 
-# ----------------------------
-# Plot Y coordinates vs. Index
-# ----------------------------
-plt.figure()
-plt.plot(df1["EventIndex"], df1["RefinedCenterY"], marker='o', linestyle='-', label="RefinedCenterY")
-plt.plot(df2["data_index"], df2["center_y"], marker='o', linestyle='-', label="center_y")
-plt.xlabel("Index")
-plt.ylabel("Y Coordinate")
-plt.title("Y Coordinate vs. Index")
-plt.legend()
-plt.grid(True)
-plt.tight_layout()
+fig.tight_layout()
 plt.show()
@@ -1,28 +1,28 @@
 #!/usr/bin/env python3
+import re
 import sys
 
+# A 'res' or 'p0/max_ss' assignment; the value ends at whitespace or a ';' comment.
+GEOM_KEY_PATTERN = re.compile(r'(res|p0/max_ss)\s*=\s*([^\s;]+)')
+
 def extract_geom_values(file_path):
-    res_val = None
-    max_ss_val = None
+    """
+    Returns (res, p0/max_ss) from a CrystFEL .geom file, or None for a key that is
+    not present. When a key is assigned more than once, the last assignment wins.
+    Lines commented out with '#' or ';' are ignored.
+    """
+    values = {}
     with open(file_path, 'r') as file:
         for line in file:
-            # Remove leading/trailing whitespace
-            line = line.strip()
-            # Skip empty lines or comments
-            if not line or line.startswith("#"):
+            # Remove leading whitespace and skip empty lines or comments
+            line = line.lstrip()
+            if not line or line[0] in "#;":
                 continue
-            # Check for the 'res' line
-            if line.startswith("res"):
-                # Splitting on '=' to extract the value
-                parts = line.split("=")
-                if len(parts) > 1:
-                    # Remove any additional units or spaces if needed
-                    res_val = float(parts[1].strip().split()[0])
-            # Check for the 'p0/max_ss' line
-            elif line.startswith("p0/max_ss"):
-                parts = line.split("=")
-                if len(parts) > 1:
-                    max_ss_val = int(parts[1].strip().split()[0])
+            match = GEOM_KEY_PATTERN.match(line)
+            if match:
+                values[match.group(1)] = match.group(2)
+    res_val = float(values['res']) if 'res' in values else None
+    max_ss_val = int(values['p0/max_ss']) if 'p0/max_ss' in values else None
     return res_val, max_ss_val
 
 if __name__ == "__main__":
@@ -1,11 +1,19 @@
 # filter_centers_import.py
 #!/usr/bin/env python3
 import os
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import tkinter as tk
 from tkinter import filedialog, messagebox
 
+# pyarrow's CSV writer is much faster than DataFrame.to_csv; fall back to pandas without it.
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
 def load_csv(filename=None):
     """
     Loads a CSV file. If a filename is provided, it uses that; otherwise, it opens a file dialog.
@@ -27,37 +35,45 @@ def load_csv(filename=None):
         messagebox.showerror("Error", f"Error loading CSV: {e}")
         return None, None
 
+# The figure of the filtering plot, reused by every apply_filtering call while it is open.
+_plot_state = {"fig": None, "axes": None}
+
+def get_plot_axes():
+    """
+    Returns (fig, (ax1, ax2), is_new): the open filtering figure with both axes cleared,
+    or a new figure (after closing any other figures) if there is none yet or it was closed.
+    """
+    fig = _plot_state["fig"]
+    if fig is not None and plt.fignum_exists(fig.number):
+        for ax in _plot_state["axes"]:
+            ax.clear()
+        return fig, _plot_state["axes"], False
+    plt.close('all')
+    fig, axes = plt.subplots(2, 1, figsize=(10, 8), sharex=True)
+    _plot_state["fig"], _plot_state["axes"] = fig, axes
+    return fig, axes, True
+
 def apply_filtering(df, csv_path, x_min, x_max, y_min, y_max, remove_outliers, outlier_std):
     """Applies the filtering logic to the dataframe and plots the results in subplots."""
-    # Close any previously opened figures.
-    plt.close('all')
-    
-    # Create a copy and ensure center columns can store empty strings.
+    # Work on float arrays of the centers; rows that fail the filter become NaN,
+    # which are written as empty fields.
     df_filtered = df.copy()
-    df_filtered['center_x'] = df_filtered['center_x'].astype(object)
-    df_filtered['center_y'] = df_filtered['center_y'].astype(object)
+    cx = df_filtered['center_x'].to_numpy(dtype=float)
+    cy = df_filtered['center_y'].to_numpy(dtype=float)
     
     # Create mask for rows with center values within the selected range.
-    mask_range = (
-        (df_filtered['center_x'].astype(float) >= x_min) &
-        (df_filtered['center_x'].astype(float) <= x_max) &
-        (df_filtered['center_y'].astype(float) >= y_min) &
-        (df_filtered['center_y'].astype(float) <= y_max)
-    )
+    mask_range = (cx >= x_min) & (cx <= x_max) & (cy >= y_min) & (cy <= y_max)
     
     # Remove outliers if enabled.
     if remove_outliers:
-        valid_in_range = df_filtered[mask_range].copy()
-        valid_in_range['center_x'] = valid_in_range['center_x'].astype(float)
-        valid_in_range['center_y'] = valid_in_range['center_y'].astype(float)
-        if not valid_in_range.empty:
-            x_mean = valid_in_range['center_x'].mean()
-            x_std = valid_in_range['center_x'].std()
-            y_mean = valid_in_range['center_y'].mean()
-            y_std = valid_in_range['center_y'].std()
+        if mask_range.any():
+            x_mean = cx[mask_range].mean()
+            x_std = cx[mask_range].std(ddof=1)
+            y_mean = cy[mask_range].mean()
+            y_std = cy[mask_range].std(ddof=1)
             mask_outlier = (
-                (abs(df_filtered['center_x'].astype(float) - x_mean) <= outlier_std * x_std) &
-                (abs(df_filtered['center_y'].astype(float) - y_mean) <= outlier_std * y_std)
+                (np.abs(cx - x_mean) <= outlier_std * x_std) &
+                (np.abs(cy - y_mean) <= outlier_std * y_std)
             )
         else:
             mask_outlier = mask_range
@@ -65,62 +81,66 @@ def apply_filtering(df, csv_path, x_min, x_max, y_min, y_max, remove_outliers, o
     else:
         valid_mask = mask_range
     
-    # For rows that do not satisfy the filter, replace center values with empty strings.
-    df_filtered.loc[~valid_mask, ['center_x', 'center_y']] = ""
+    # For rows that do not satisfy the filter, replace center values with NaN.
+    df_filtered['center_x'] = np.where(valid_mask, cx, np.nan)
+    df_filtered['center_y'] = np.where(valid_mask, cy, np.nan)
     
     # Compute and print statistics for the valid rows.
     valid_rows = df_filtered[valid_mask]
     print("=== Valid Data Statistics ===")
     print(f"Number of valid rows: {len(valid_rows)} out of {len(df_filtered)}")
+    stats = valid_rows[['center_x', 'center_y']].agg(['mean', 'median', 'std'])
     for col in ['center_x', 'center_y']:
-        try:
-            valid_floats = valid_rows[col].astype(float)
-            mean_val = valid_floats.mean()
-            median_val = valid_floats.median()
-            std_val = valid_floats.std()
-            print(f"{col} => mean: {mean_val:.3f}, median: {median_val:.3f}, std: {std_val:.3f}")
-        except Exception:
-            print(f"{col} has non-numeric values.")
+        mean_val, median_val, std_val = stats[col]
+        print(f"{col} => mean: {mean_val:.3f}, median: {median_val:.3f}, std: {std_val:.3f}")
     
     # Save the modified CSV.
     output_folder = os.path.dirname(csv_path)
     base = os.path.basename(csv_path)
     basename, ext = os.path.splitext(base)
     output_filename = os.path.join(output_folder, f"{basename}_filtered.csv")
-    df_filtered.to_csv(output_filename, index=False)
+    # NaN centers become nulls, which both writers leave as empty fields.
+    written = False
+    if pa is not None:
+        try:
+            pa_csv.write_csv(pa.Table.from_pandas(df_filtered, preserve_index=False), output_filename)
+            written = True
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # A column pyarrow cannot convert (e.g. mixed types); let pandas write it.
+            pass
+    if not written:
+        df_filtered.to_csv(output_filename, index=False, na_rep="")
     print(f"\nFiltered CSV saved to: {output_filename}\n")
     
-    # Prepare valid rows for plotting.
-    valid_rows_numeric = valid_rows.copy()
-    valid_rows_numeric['center_x'] = valid_rows_numeric['center_x'].apply(lambda v: float(v) if v != "" else None)
-    valid_rows_numeric['center_y'] = valid_rows_numeric['center_y'].apply(lambda v: float(v) if v != "" else None)
-    valid_rows_numeric = valid_rows_numeric.dropna(subset=['center_x', 'center_y'])
-    
     # Use the 'data_index' column as the x-axis for the plots.
-    if 'data_index' not in valid_rows_numeric.columns:
+    if 'data_index' not in valid_rows.columns:
         print("Warning: 'data_index' column not found in CSV. Using default DataFrame index.")
-        x_axis = valid_rows_numeric.index
+        x_axis = valid_rows.index
     else:
-        x_axis = valid_rows_numeric['data_index']
+        x_axis = valid_rows['data_index']
     
-    # Create subplots in a single figure.
-    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 8), sharex=True)
+    # Plot into the open figure if there is one, otherwise create it.
+    fig, (ax1, ax2), is_new = get_plot_axes()
     
     # Plot center_x vs data_index.
-    ax1.plot(x_axis, valid_rows_numeric['center_x'], marker='o', linestyle='-')
+    ax1.plot(x_axis, valid_rows['center_x'], marker='o', linestyle='-')
     ax1.set_ylabel('Center X')
     ax1.set_title('Center X vs Data Index')
     ax1.grid(True)
     
     # Plot center_y vs data_index.
-    ax2.plot(x_axis, valid_rows_numeric['center_y'], marker='o', linestyle='-')
+    ax2.plot(x_axis, valid_rows['center_y'], marker='o', linestyle='-')
     ax2.set_xlabel('Data Index')
     ax2.set_ylabel('Center Y')
     ax2.set_title('Center Y vs Data Index')
     ax2.grid(True)
     
-    plt.tight_layout()
-    plt.show()
+    fig.tight_layout()
+    if is_new:
+        plt.show()
+    else:
+        # The window is already shown; just redraw it with the new data.
+        fig.canvas.draw_idle()
 
 def get_ui(parent):
     """
@@ -162,14 +182,12 @@ def get_ui(parent):
             state["df"] = df
             state["csv_path"] = path
             try:
-                x_min_default = df['center_x'].min()
-                x_max_default = df['center_x'].max()
-                y_min_default = df['center_y'].min()
-                y_max_default = df['center_y'].max()
-                x_min_var.set(x_min_default)
-                x_max_var.set(x_max_default)
-                y_min_var.set(y_min_default)
-                y_max_var.set(y_max_default)
+                # Min and max of both center columns in one aggregation.
+                bounds = df[['center_x', 'center_y']].agg(['min', 'max'])
+                x_min_var.set(bounds.loc['min', 'center_x'])
+                x_max_var.set(bounds.loc['max', 'center_x'])
+                y_min_var.set(bounds.loc['min', 'center_y'])
+                y_max_var.set(bounds.loc['max', 'center_y'])
             except Exception as e:
                 print(f"Error setting default values: {e}")
     
@@ -208,12 +226,13 @@ def get_ui(parent):
             messagebox.showerror("Error", "Please load a CSV file first.")
             return
         try:
-            x_min = float(x_min_var.get())
-            x_max = float(x_max_var.get())
-            y_min = float(y_min_var.get())
-            y_max = float(y_max_var.get())
+            # DoubleVar.get() already parses the entry to a float (and raises if it is not one).
+            x_min = x_min_var.get()
+            x_max = x_max_var.get()
+            y_min = y_min_var.get()
+            y_max = y_max_var.get()
             remove_outliers = remove_outliers_var.get()
-            outlier_std = float(outlier_std_var.get())
+            outlier_std = outlier_std_var.get()
             apply_filtering(state["df"], state["csv_path"], x_min, x_max, y_min, y_max, remove_outliers, outlier_std)
         except Exception as e:
             messagebox.showerror("Error", f"Error during filtering: {e}")
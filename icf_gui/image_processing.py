@@ -3,31 +3,113 @@
 import os
 import h5py
 import numpy as np
+import numba
 import pandas as pd
 from tqdm import tqdm
-from multiprocessing import Pool
+from multiprocessing import get_all_start_methods, get_context, shared_memory
 
-from ICFTOTAL import center_of_mass_initial_guess, find_diffraction_center
+# pyarrow's CSV writer is much faster than DataFrame.to_csv; fall back to pandas without it.
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
 
-def compute_center_for_frame(args):
+from ICFTOTAL import center_of_mass_initial_guess, find_diffraction_center, warm_up_kernels
+
+# Per-worker state, filled once by _init_worker.
+_worker_state = {}
+
+def _init_worker(image_file, cache_nbytes, shm_name, mask_shape, mask_dtype):
+    """
+    Pool initializer: opens the H5 file once per worker process and keeps the image
+    dataset (and its chunk cache) alive for all the frames that worker handles.
+    Also attaches to the shared-memory block holding the mask and keeps a read-only
+    view of it, so the mask is not pickled into every task.
+    """
+    _worker_state['f'] = h5py.File(image_file, 'r', rdcc_nbytes=cache_nbytes, rdcc_nslots=10007)
+    _worker_state['dset'] = _worker_state['f']['/entry/data/images']
+    _worker_state['shm'] = shared_memory.SharedMemory(name=shm_name)
+    mask = np.ndarray(mask_shape, dtype=mask_dtype, buffer=_worker_state['shm'].buf)
+    mask.flags.writeable = False
+    _worker_state['mask'] = mask
+    # The pool already runs one worker per core, so each worker runs the parallel
+    # Numba kernels on a single thread instead of starting a core-sized thread pool.
+    numba.set_num_threads(1)
+    # Compile (or load from the Numba cache) the kernels before the first task arrives.
+    warm_up_kernels()
+
+def chunk_cache_nbytes(dset, min_nbytes=64 * 1024 * 1024):
+    """
+    Size of the HDF5 chunk cache for reading dset: at least min_nbytes, and always
+    room for two chunks. A chunk larger than the cache bypasses it and is decompressed
+    again for every frame read from it.
+    """
+    if dset.chunks is None:
+        return min_nbytes
+    return max(min_nbytes, 2 * int(np.prod(dset.chunks)) * dset.dtype.itemsize)
+
+def read_frames(dset, frame_nums, out):
+    """
+    Reads the given increasing frame numbers into the float32 buffer out (at least
+    len(frame_nums) frames long) with a single H5 read: an evenly spaced run becomes one
+    strided hyperslab, anything else one point selection. HDF5 converts the dtype during
+    the read, so no converted copy of the frames is made. Returns the filled part of out.
+    """
+    frames = out[:len(frame_nums)]
+    if len(frame_nums) == 1:
+        sel = np.s_[frame_nums[0]:frame_nums[0] + 1]
+    else:
+        step = frame_nums[1] - frame_nums[0]
+        if all(b - a == step for a, b in zip(frame_nums, frame_nums[1:])):
+            sel = np.s_[frame_nums[0]:frame_nums[-1] + 1:step]
+        else:
+            sel = np.s_[list(frame_nums)]
+    dset.read_direct(frames, source_sel=sel)
+    return frames
+
+def read_index_for_frames(index_dset, n_images, frame_interval):
+    """
+    Reads the data index of every frame_interval-th frame plus the last frame, i.e. of the
+    frames to process, with one strided read instead of loading the whole index dataset
+    (an h5py fancy selection of the same frames is far slower than either).
+    """
+    data_index = index_dset[::frame_interval]
+    if (n_images - 1) % frame_interval:
+        data_index = np.append(data_index, index_dset[n_images - 1])
+    return data_index
+
+def compute_centers_for_batch(args):
     """
     Helper function for multiprocessing.
-    Loads one frame from the H5 file, processes it, and returns (frame_num, center_x, center_y).
-    If the computed center is invalid or out-of-bounds, returns NaN values.
+    Loads a batch of frames from the worker's open H5 file with one read, processes each
+    frame, and returns the arrays (frame_nums, center_x, center_y).
+    If a computed center is invalid or out-of-bounds, NaN values are returned for that frame.
     """
-    (frame_num, image_file, mask, n_wedges, n_rad_bins,
+    (frame_nums, n_wedges, n_rad_bins,
      xatol, fatol, verbose, xmin, xmax, ymin, ymax) = args
+    mask = _worker_state['mask']
 
-    with h5py.File(image_file, 'r') as f:
-        img = f['/entry/data/images'][frame_num].astype(np.float32)
+    # Read the batch straight into the worker's float32 scratch buffer, grown only when
+    # a batch is longer than any before it.
+    dset = _worker_state['dset']
+    buf = _worker_state.get('frames')
+    if buf is None or len(buf) < len(frame_nums):
+        buf = _worker_state['frames'] = np.empty((len(frame_nums),) + dset.shape[1:], dtype=np.float32)
+    frames = read_frames(dset, frame_nums, buf)
 
-    cx, cy = process_single_image(img, mask, n_wedges, n_rad_bins, xatol, fatol, verbose, xmin, xmax, ymin, ymax)
+    cx_arr = np.empty(len(frames), dtype=float)
+    cy_arr = np.empty(len(frames), dtype=float)
+    for i, img in enumerate(frames):
+        cx_arr[i], cy_arr[i] = process_single_image(img, mask, n_wedges, n_rad_bins, xatol, fatol, verbose, xmin, xmax, ymin, ymax)
 
-    if not (np.isfinite(cx) and np.isfinite(cy) and
-            xmin <= cx < xmax and ymin <= cy < ymax):
-        cx, cy = np.nan, np.nan
+    # Invalidate non-finite or out-of-bounds centers for the whole batch at once.
+    valid = (np.isfinite(cx_arr) & np.isfinite(cy_arr) &
+             (cx_arr >= xmin) & (cx_arr < xmax) & (cy_arr >= ymin) & (cy_arr < ymax))
+    cx_arr[~valid] = np.nan
+    cy_arr[~valid] = np.nan
 
-    return frame_num, cx, cy
+    return frame_nums, cx_arr, cy_arr
 
 def process_single_image(img, mask, n_wedges, n_rad_bins, xatol, fatol, verbose, xmin, xmax, ymin, ymax):
     # Get the initial center-of-mass guess.
@@ -49,88 +131,6 @@ def process_single_image(img, mask, n_wedges, n_rad_bins, xatol, fatol, verbose,
     )
     return refined_center
 
-# def process_images_apply_async(
-#     image_file,
-#     mask,
-#     frame_interval=10,
-#     xatol=0.01,
-#     fatol=10,
-#     n_wedges=4,
-#     n_rad_bins=100,
-#     xmin=0,
-#     xmax=1024,
-#     ymin=0,
-#     ymax=1024,
-#     verbose=False
-# ):
-#     """
-#     Processes the specified frames from the H5 image file in parallel using apply_async
-#     (without chunking) so that the progress bar is updated for every computed center.
-#     Results are stored in a CSV in the same folder as the image file.
-#     """
-#     # 1) Open the H5 file to get the number of images and index dataset.
-#     with h5py.File(image_file, 'r') as f:
-#         n_images = f['/entry/data/images'].shape[0]
-#         index_dset = f.get('/entry/data/index')
-#         if index_dset is not None:
-#             data_index_all = index_dset[:]
-#         else:
-#             raise ValueError("Dataset '/entry/data/index' is required but not found.")
-
-#     # 2) Create a DataFrame to store centers.
-#     df = pd.DataFrame({
-#         "frame_number": np.arange(n_images),
-#         "data_index": data_index_all,
-#         "center_x": np.full(n_images, np.nan, dtype=float),
-#         "center_y": np.full(n_images, np.nan, dtype=float),
-#     })
-
-#     # 3) Identify which frames to process.
-#     frames_to_process = set([0, n_images - 1]) | {i for i in range(n_images) if i % frame_interval == 0}
-#     frames_to_process = sorted(frames_to_process)
-
-#     # 4) Build a list of tasks.
-#     tasks = []
-#     for fn in frames_to_process:
-#         tasks.append((
-#             fn,         # frame number
-#             image_file, # image file path
-#             mask,
-#             n_wedges, n_rad_bins,
-#             xatol, fatol,
-#             verbose,
-#             xmin, xmax, ymin, ymax
-#         ))
-
-#     # 5) Create a tqdm progress bar.
-#     pbar = tqdm(total=len(tasks), desc="Processing frames", unit="frame")
-
-#     # 6) Define a callback to update the progress bar and DataFrame.
-#     def update_callback(result):
-#         frame_num, cx, cy = result
-#         df.at[frame_num, "center_x"] = cx
-#         df.at[frame_num, "center_y"] = cy
-#         pbar.update(1)
-
-#     # 7) Process each task individually using apply_async.
-#     with Pool() as pool:
-#         async_results = [pool.apply_async(compute_center_for_frame, args=(task,), callback=update_callback)
-#                          for task in tasks]
-#         # Wait for all tasks to finish.
-#         [res.get() for res in async_results]
-
-#     pbar.close()
-
-#     # 8) Keep only rows for frames that were processed and write out the CSV
-#     df = df[df["frame_number"].isin(frames_to_process)]
-
-#     csv_file = os.path.join(
-#         os.path.dirname(image_file),
-#         f"centers_xatol_{xatol}_frameinterval_{frame_interval}.csv"
-#     )
-#     df.to_csv(csv_file, index=False)
-#     print(f"Created CSV with {len(df)} found centers in:\n{csv_file}")
-
 def process_images_apply_async(
     image_file,
     mask,
@@ -143,68 +143,88 @@ def process_images_apply_async(
     xmax=1024,
     ymin=0,
     ymax=1024,
-    verbose=False
+    verbose=False,
+    frames_per_batch=16
 ):
     """
-    Processes the specified frames from the H5 image file in parallel using apply_async
-    (without chunking) so that the progress bar is updated for every computed center.
+    Processes the specified frames from the H5 image file in parallel using imap_unordered.
+    Frames are handed out in batches of frames_per_batch consecutive frames to process,
+    which each worker reads with a single (strided) H5 read; the progress bar is
+    updated per finished batch. The mask is shared with the workers through shared memory.
     Results are stored in a CSV in the same folder as the image file.
     """
-    # 1) Open the H5 file in read/write mode to get the number of images and index dataset.
+    # 1) Open the H5 file in read/write mode to get the number of images, identify which
+    #    frames to process and read the index of those frames only.
     with h5py.File(image_file, 'r+') as f:
         n_images = f['/entry/data/images'].shape[0]
+        cache_nbytes = chunk_cache_nbytes(f['/entry/data/images'])
+        frames_to_process = np.union1d(np.arange(0, n_images, frame_interval), [0, n_images - 1])
         index_dset = f.get('/entry/data/index')
         if index_dset is None:
             # If the index dataset is missing, create it using a sequential index.
             print("Dataset '/entry/data/index' is missing. Creating it automatically.")
-            data_index_all = np.arange(n_images)
-            f.create_dataset('/entry/data/index', data=data_index_all)
+            f.create_dataset('/entry/data/index', data=np.arange(n_images))
+            data_index_sel = frames_to_process
         else:
-            data_index_all = index_dset[:]
+            data_index_sel = read_index_for_frames(index_dset, n_images, frame_interval)
 
-    # 2) Create a DataFrame to store centers.
-    df = pd.DataFrame({
-        "frame_number": np.arange(n_images),
-        "data_index": data_index_all,
-        "center_x": np.full(n_images, np.nan, dtype=float),
-        "center_y": np.full(n_images, np.nan, dtype=float),
-    })
+    # 2) Preallocate the centers of the frames to process.
+    center_x = np.full(len(frames_to_process), np.nan, dtype=float)
+    center_y = np.full(len(frames_to_process), np.nan, dtype=float)
 
-    # 3) Identify which frames to process.
-    frames_to_process = set([0, n_images - 1]) | {i for i in range(n_images) if i % frame_interval == 0}
-    frames_to_process = sorted(frames_to_process)
-
-    # 4) Build a list of tasks.
+    # 3) Build a list of tasks, one per batch of frames (the mask goes through shared memory).
+    mask = np.asarray(mask, dtype=bool)
     tasks = []
-    for fn in frames_to_process:
-        tasks.append((fn, image_file, mask,
+    for start in range(0, len(frames_to_process), frames_per_batch):
+        tasks.append((frames_to_process[start:start + frames_per_batch],
                       n_wedges, n_rad_bins,
                       xatol, fatol,
                       verbose,
                       xmin, xmax, ymin, ymax))
 
-    # 5) Create a tqdm progress bar.
-    pbar = tqdm(total=len(tasks), desc="Processing frames", unit="frame")
-
-    # 6) Define a callback to update the progress bar and DataFrame.
-    def update_callback(result):
-        frame_num, cx, cy = result
-        df.at[frame_num, "center_x"] = cx
-        df.at[frame_num, "center_y"] = cy
-        pbar.update(1)
-
-    # 7) Process each task individually using apply_async.
-    with Pool() as pool:
-        async_results = [pool.apply_async(compute_center_for_frame, args=(task,), callback=update_callback)
-                         for task in tasks]
-        # Wait for all tasks to finish.
-        [res.get() for res in async_results]
+    # 4) Create a tqdm progress bar.
+    pbar = tqdm(total=len(frames_to_process), desc="Processing frames", unit="frame")
+
+    # 5) Copy the mask into shared memory and process the batches with imap_unordered,
+    #    updating the progress bar and center arrays as each batch finishes;
+    #    each worker opens the file and attaches to the mask once.
+    #    Numba's TBB worker threads do not survive fork(): once this process has run a
+    #    parallel kernel (e.g. the LOWESS fit in the same GUI), forked workers leave it
+    #    hanging at exit. The workers are therefore started from a forkserver where there is one.
+    shm = shared_memory.SharedMemory(create=True, size=max(mask.nbytes, 1))
+    try:
+        shm_mask = np.ndarray(mask.shape, dtype=mask.dtype, buffer=shm.buf)
+        shm_mask[:] = mask
+        ctx = get_context("forkserver" if "forkserver" in get_all_start_methods() else None)
+        chunksize = max(1, len(tasks) // (os.cpu_count() * 4))
+        with ctx.Pool(initializer=_init_worker,
+                      initargs=(image_file, cache_nbytes, shm.name, mask.shape, mask.dtype.str)) as pool:
+            for frame_nums, cxs, cys in pool.imap_unordered(compute_centers_for_batch, tasks, chunksize=chunksize):
+                rows = np.searchsorted(frames_to_process, frame_nums)
+                center_x[rows] = cxs
+                center_y[rows] = cys
+                pbar.update(len(frame_nums))
+            # Let the workers exit on their own (leaving the block would terminate them).
+            pool.close()
+            pool.join()
+        del shm_mask
+    finally:
+        shm.close()
+        shm.unlink()
 
     pbar.close()
 
-    # 8) Keep only rows for frames that were processed and write out the CSV.
-    df = df[df["frame_number"].isin(frames_to_process)]
+    # 6) Build the DataFrame of the processed frames and write out the CSV.
+    df = pd.DataFrame({
+        "frame_number": frames_to_process,
+        "data_index": data_index_sel,
+        "center_x": center_x,
+        "center_y": center_y,
+    })
     csv_file = os.path.join(os.path.dirname(image_file),
                             f"centers_xatol_{xatol}_frameinterval_{frame_interval}.csv")
-    df.to_csv(csv_file, index=False)
+    if pa is not None:
+        pa_csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), csv_file)
+    else:
+        df.to_csv(csv_file, index=False)
     print(f"Created CSV with {len(df)} found centers in:\n{csv_file}")
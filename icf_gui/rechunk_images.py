@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import sys
+import h5py
+from tqdm import tqdm
+
+# Plugin filters (Bitshuffle/LZ4, Blosc, ...) of detector stacks such as Eiger's; optional,
+# since without them such stacks can neither be read nor rewritten here.
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+def filter_pipeline(dset):
+    """
+    Returns the filters (id, flags, parameters) of dset in the order they are applied.
+    """
+    plist = dset.id.get_create_plist()
+    return [plist.get_filter(i)[:3] for i in range(plist.get_nfilters())]
+
+def create_rechunked_like(dst, name, src_dset, chunks):
+    """
+    Create dataset name in dst with the shape, dtype and creation properties of
+    src_dset (its full filter pipeline included, plugin filters and checksums too),
+    changing only the chunk shape. Raises ValueError if a filter of src_dset is not
+    available to this HDF5 library, since the data could then not be rewritten with it.
+    """
+    dcpl = src_dset.id.get_create_plist()
+    missing = [str(fid) for fid, _, _ in filter_pipeline(src_dset) if not h5py.h5z.filter_avail(fid)]
+    if missing:
+        raise ValueError(f"HDF5 filter(s) {', '.join(missing)} of {src_dset.name} are not available "
+                         "(install hdf5plugin or set HDF5_PLUGIN_PATH); refusing to drop them.")
+    dcpl.set_chunk(chunks)
+    dsid = h5py.h5d.create(dst.id, name.encode(), src_dset.id.get_type(), src_dset.id.get_space(), dcpl=dcpl)
+    return h5py.Dataset(dsid)
+
+def copy_raw_chunks(src_dset, dst_dset):
+    """
+    Copy every stored chunk of src_dset into dst_dset as raw (still compressed) bytes,
+    skipping the decompress + recompress round trip. Both datasets must have the same
+    shape, dtype, chunk shape and filter pipeline.
+    """
+    src_id, dst_id = src_dset.id, dst_dset.id
+    with tqdm(total=src_id.get_num_chunks(), desc="Copying image chunks", unit="chunk") as pbar:
+        def copy_chunk(info):
+            filter_mask, chunk = src_id.read_direct_chunk(info.chunk_offset)
+            dst_id.write_direct_chunk(info.chunk_offset, chunk, filter_mask)
+            pbar.update(1)
+        src_id.chunk_iter(copy_chunk)
+
+def rechunk_images(src_path, dst_path, frames_per_chunk=1):
+    """
+    Write a copy of src_path in which '/entry/data/images' is chunked with
+    frames_per_chunk frames per chunk (one frame by default), so that reading a
+    single frame only decompresses that frame. The stack keeps its whole filter
+    pipeline (compression, shuffle, checksums and plugin filters such as Bitshuffle)
+    and every other object in the file is copied unchanged.
+    Filters this HDF5 library cannot apply are refused with a ValueError.
+    Run this once on a stack written with multi-frame chunks before center finding.
+
+    Parameters
+    ----------
+    src_path : str
+        Path to the original HDF5 file.
+    dst_path : str
+        Path where the rechunked HDF5 file will be created.
+    frames_per_chunk : int, optional
+        Number of frames per chunk along the first axis (default is 1).
+    """
+    with h5py.File(src_path, 'r') as src, h5py.File(dst_path, 'w') as dst:
+        # 1. Copy everything except the image stack.
+        def copy_except_images(name, obj):
+            if name == 'entry/data/images':
+                return
+            if isinstance(obj, h5py.Group):
+                grp = dst.require_group(name)
+                grp.attrs.update(obj.attrs)
+            else:
+                dst.copy(obj, name)
+        dst.attrs.update(src.attrs)
+        src.visititems(copy_except_images)
+
+        # 2. Recreate the image stack with the new chunk shape and the same creation
+        #    properties (filters included).
+        dset = src['entry/data/images']
+        out = create_rechunked_like(dst, 'entry/data/images', dset,
+                                    (frames_per_chunk,) + dset.shape[1:])
+        out.attrs.update(dset.attrs)
+
+        # 3. If the stack already has the requested chunk shape and filters, transfer the
+        #    compressed chunks as they are (chunk_iter needs h5py >= 3.8). Otherwise copy
+        #    the frames in blocks that follow the source chunking, so every source chunk
+        #    is decompressed exactly once.
+        if (dset.chunks == out.chunks and hasattr(dset.id, 'chunk_iter')
+                and filter_pipeline(dset) == filter_pipeline(out)):
+            copy_raw_chunks(dset, out)
+        else:
+            step = dset.chunks[0] if dset.chunks is not None else 64
+            for start in tqdm(range(0, dset.shape[0], step), desc="Rechunking images", unit="block"):
+                stop = min(start + step, dset.shape[0])
+                out[start:stop] = dset[start:stop]
+
+    print(f"Rechunked HDF5 file created: {dst_path}")
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python rechunk_images.py <src.h5> <dst.h5> [frames_per_chunk]")
+        sys.exit(1)
+    rechunk_images(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) == 4 else 1)
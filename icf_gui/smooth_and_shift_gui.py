@@ -7,7 +7,7 @@ import matplotlib.pyplot as plt
 import tkinter as tk
 from tkinter import filedialog
 
-from statsmodels.nonparametric.smoothers_lowess import lowess
+from lowess_numba import lowess_grid_xy
 
 # Custom modules for updating H5 files.
 # from update_h5_pb import create_updated_h5_pb
@@ -16,8 +16,20 @@ from extract_geom_values import extract_geom_values
 
 # Global containers.
 shifted_csv_path = [None]      # To store the path to the saved smoothed CSV.
+shifted_parquet_path = [None]  # The Parquet copy saved along with it (None if not written).
 global_smoothed_df = [None]      # To store the computed DataFrame from preview.
 
+# LOWESS fit of the last preview (before the shifts), keyed by
+# (csv_path, csv_mtime, frac, use_numba), so changing only the shifts does not refit.
+_lowess_cache = {}
+
+# Preview plots are thinned to about this many points per line.
+MAX_PLOT_POINTS = 2000
+
+# The preview figure and its four lines (original/smoothed X, original/smoothed Y),
+# reused by every preview while the window is open.
+_plot_state = {"fig": None, "axs": None, "lines": None}
+
 def get_ui(parent):
     """
     Creates and returns a Frame containing the LOWESS/H5 Update GUI.
@@ -59,6 +71,14 @@ def get_ui(parent):
     lowess_scale = tk.Scale(frame_2a, from_=0.01, to=1.0, resolution=0.01, orient=tk.HORIZONTAL,
                             variable=lowess_frac_var, label="Lowess frac:", length=300)
     lowess_scale.grid(row=2, column=0, columnspan=4, pady=5)
+
+    # Numba LOWESS for large CSVs (small ones always go through statsmodels).
+    use_numba_var = tk.BooleanVar(frame, value=True)
+    tk.Checkbutton(frame_2a, text="Use Numba LOWESS (large CSVs)", variable=use_numba_var).grid(row=2, column=4, sticky="w")
+
+    # Plotting can be skipped for very large CSVs.
+    show_plot_var = tk.BooleanVar(frame, value=True)
+    tk.Checkbutton(frame_2a, text="Show plot", variable=show_plot_var).grid(row=2, column=5, sticky="w")
     
     # Buttons for preview and saving.
     tk.Button(frame_2a, text="Preview LOWESS & Plot", command=lambda: preview_lowess()).grid(row=3, column=0, columnspan=2, pady=5)
@@ -110,9 +130,15 @@ def get_ui(parent):
     # Progress bar checkbox.
     pb_var = tk.BooleanVar(frame, value=False)
     tk.Checkbutton(frame_2b, text="Enable Progress Bar", variable=pb_var).grid(row=3, column=0, columnspan=2, sticky="w")
+    # Overlay checkbox: link the original file's data instead of copying it.
+    overlay_var = tk.BooleanVar(frame, value=False)
+    tk.Checkbutton(frame_2b, text="Link original data (overlay, no copy)", variable=overlay_var).grid(row=3, column=2, sticky="w")
+    # Blosc checkbox: Blosc instead of gzip for the updated datasets (readers need hdf5plugin too).
+    blosc_var = tk.BooleanVar(frame, value=False)
+    tk.Checkbutton(frame_2b, text="Blosc compression (needs hdf5plugin)", variable=blosc_var).grid(row=4, column=0, columnspan=2, sticky="w")
     
     # Update H5 button.
-    tk.Button(frame_2b, text="Update H5 with Smoothed Centers", command=lambda: update_h5_file()).grid(row=4, column=0, columnspan=3, pady=5)
+    tk.Button(frame_2b, text="Update H5 with Smoothed Centers", command=lambda: update_h5_file()).grid(row=5, column=0, columnspan=3, pady=5)
     
     # --- Internal function definitions ---
     def preview_lowess():
@@ -131,11 +157,12 @@ def get_ui(parent):
             if col not in df.columns:
                 print(f"CSV must contain '{col}' column.")
                 return
-        # Sort by data_index.
-        df = df.sort_values("data_index").reset_index(drop=True)
-        data_idx = df["data_index"].values
-        cx = df["center_x"].values
-        cy = df["center_y"].values
+        # Sort the three columns by data_index (without copying the whole DataFrame).
+        data_idx = df["data_index"].to_numpy()
+        order = np.argsort(data_idx, kind="stable")
+        data_idx = data_idx[order]
+        cx = df["center_x"].to_numpy()[order]
+        cy = df["center_y"].to_numpy()[order]
         # Identify valid points.
         valid_mask = ~np.isnan(cx) & ~np.isnan(cy)
         valid_data_idx = data_idx[valid_mask]
@@ -150,34 +177,74 @@ def get_ui(parent):
             return
         if len(valid_data_idx) < 2:
             print("Too few valid points for a LOWESS fit. We'll leave all centers as-is.")
-            smoothed_df = df.copy()
+            # Built from the sorted column arrays rather than copying the whole DataFrame.
+            smoothed_df = pd.DataFrame({
+                "data_index": data_idx,
+                "center_x": cx,
+                "center_y": cy
+            })
         else:
-            lowess_x = lowess(valid_cx, valid_data_idx, frac=frac_val, return_sorted=True)
-            lowess_y = lowess(valid_cy, valid_data_idx, frac=frac_val, return_sorted=True)
             min_idx, max_idx = int(data_idx.min()), int(data_idx.max())
             all_idx = np.arange(min_idx, max_idx + 1)
-            smoothed_x = np.interp(all_idx, lowess_x[:, 0], lowess_x[:, 1])
-            smoothed_y = np.interp(all_idx, lowess_y[:, 0], lowess_y[:, 1])
-            smoothed_x += shift_x_val
-            smoothed_y += shift_y_val
+            key = (csv_file, os.path.getmtime(csv_file), frac_val, use_numba_var.get())
+            if key in _lowess_cache:
+                lowess_x, lowess_y = _lowess_cache[key]
+            else:
+                # Fits closer together than 1% of the index range are interpolated (R's default delta).
+                delta = 0.01 * (valid_data_idx[-1] - valid_data_idx[0])
+                lowess_x, lowess_y = lowess_grid_xy(valid_cx, valid_cy, valid_data_idx, all_idx, frac_val,
+                                                    use_numba=use_numba_var.get(), delta=delta)
+                # Only the last fit is kept.
+                _lowess_cache.clear()
+                _lowess_cache[key] = (lowess_x, lowess_y)
+            # New arrays, so the cached fit stays unshifted.
+            smoothed_x = lowess_x + shift_x_val
+            smoothed_y = lowess_y + shift_y_val
             smoothed_df = pd.DataFrame({
                 "data_index": all_idx,
                 "center_x": smoothed_x,
                 "center_y": smoothed_y
             })
         global_smoothed_df[0] = smoothed_df
-        plt.close('all')
-        fig, axs = plt.subplots(1, 2, figsize=(12, 5))
-        axs[0].plot(valid_data_idx, valid_cx, 'o--', label='Original X (valid)', markersize=4)
-        axs[1].plot(valid_data_idx, valid_cy, 'o--', label='Original Y (valid)', markersize=4)
-        axs[0].plot(smoothed_df["data_index"], smoothed_df["center_x"], 'o-', label='Smoothed X (full)', markersize=4)
-        axs[1].plot(smoothed_df["data_index"], smoothed_df["center_y"], 'o-', label='Smoothed Y (full)', markersize=4)
-        axs[0].set_title("Center X vs. data_index")
-        axs[1].set_title("Center Y vs. data_index")
-        axs[0].legend()
-        axs[1].legend()
-        plt.tight_layout()
-        plt.show()
+        if show_plot_var.get():
+            # Large series are thinned and rasterized to keep the preview responsive.
+            stride = max(1, len(valid_data_idx) // MAX_PLOT_POINTS)
+            orig_idx = valid_data_idx[::stride]
+            orig_cx = valid_cx[::stride]
+            orig_cy = valid_cy[::stride]
+            sm_idx = smoothed_df["data_index"].to_numpy()
+            stride = max(1, len(sm_idx) // MAX_PLOT_POINTS)
+            sm_cx = smoothed_df["center_x"].to_numpy()[::stride]
+            sm_cy = smoothed_df["center_y"].to_numpy()[::stride]
+            sm_idx = sm_idx[::stride]
+            fig = _plot_state["fig"]
+            if fig is not None and plt.fignum_exists(fig.number):
+                # The window is already shown; swap the data of its lines and redraw.
+                axs = _plot_state["axs"]
+                line_ox, line_oy, line_sx, line_sy = _plot_state["lines"]
+                line_ox.set_data(orig_idx, orig_cx)
+                line_oy.set_data(orig_idx, orig_cy)
+                line_sx.set_data(sm_idx, sm_cx)
+                line_sy.set_data(sm_idx, sm_cy)
+                for ax in axs:
+                    ax.relim()
+                    ax.autoscale_view()
+                fig.canvas.draw_idle()
+            else:
+                plt.close('all')
+                fig, axs = plt.subplots(1, 2, figsize=(12, 5))
+                line_ox, = axs[0].plot(orig_idx, orig_cx, 'o--', label='Original X (valid)', markersize=4, rasterized=True)
+                line_oy, = axs[1].plot(orig_idx, orig_cy, 'o--', label='Original Y (valid)', markersize=4, rasterized=True)
+                line_sx, = axs[0].plot(sm_idx, sm_cx, 'o-', label='Smoothed X (full)', markersize=4, rasterized=True)
+                line_sy, = axs[1].plot(sm_idx, sm_cy, 'o-', label='Smoothed Y (full)', markersize=4, rasterized=True)
+                axs[0].set_title("Center X vs. data_index")
+                axs[1].set_title("Center Y vs. data_index")
+                axs[0].legend()
+                axs[1].legend()
+                plt.tight_layout()
+                _plot_state["fig"], _plot_state["axs"] = fig, axs
+                _plot_state["lines"] = (line_ox, line_oy, line_sx, line_sy)
+                plt.show()
         print("Preview complete. If satisfied, click 'Save Smoothed CSV' to create the CSV file.")
     
     def save_smoothed_csv():
@@ -199,7 +266,15 @@ def get_ui(parent):
         )
         try:
             global_smoothed_df[0].to_csv(out_path, index=False)
+            # A binary copy next to the CSV, which the H5 update reads instead of parsing
+            # the CSV; the CSV is kept for inspection.
+            parquet_path = os.path.splitext(out_path)[0] + ".parquet"
+            try:
+                global_smoothed_df[0].to_parquet(parquet_path, index=False)
+            except ImportError:
+                parquet_path = None
             shifted_csv_path[0] = out_path
+            shifted_parquet_path[0] = parquet_path
             # Automatically update the Smoothed CSV field in Section 2B.
             smoothed_csv_path_var.set(out_path)
             print(f"Smoothed CSV saved:\n{out_path}")
@@ -232,12 +307,18 @@ def get_ui(parent):
         subfolder_path = os.path.join(os.path.dirname(h5_file), base_name)
         os.makedirs(subfolder_path, exist_ok=True)
         new_h5_path = os.path.join(subfolder_path, base_name + '.h5')
+        mode = "overlay" if overlay_var.get() else "copy"
+        compression = "blosc" if blosc_var.get() else "gzip"
+        # Read the Parquet copy only for the CSV saved in Section 2A, which was written
+        # together with it; any other selected file is read as it is.
+        centers_file = csv_file
+        if csv_file == shifted_csv_path[0] and shifted_parquet_path[0] is not None:
+            centers_file = shifted_parquet_path[0]
         try:
-            if pb_var.get():
-                create_updated_h5_pb(h5_file, new_h5_path, csv_file, use_progress=True, framesize=max_ss_val+1, pixels_per_meter=res_val)
-            else:
-                create_updated_h5_pb(h5_file, new_h5_path, csv_file, use_progress=False, framesize=max_ss_val+1, pixels_per_meter=res_val)
+            create_updated_h5_pb(h5_file, new_h5_path, centers_file, use_progress=pb_var.get(), framesize=max_ss_val+1, pixels_per_meter=res_val, mode=mode, compression=compression)
             print(f"Updated H5 file created at:\n{new_h5_path}")
+            if mode == "overlay":
+                print("Note: the data is linked from the original file, which must stay in place.")
         except Exception as e:
             print(f"Error updating H5 file: {e}")
     
@@ -8,6 +8,20 @@ from tkinter import filedialog, messagebox
 # Import your updated processing function.
 from image_processing_fast import process_images_apply_async
 
+def read_mask(dset):
+    """
+    Reads a mask dataset into a boolean array (non-zero = valid pixel). One-byte masks
+    (bool, uint8, int8) are read straight into the output buffer and converted in
+    place, so no second full-size copy is made; other dtypes are read and converted.
+    """
+    if dset.dtype.itemsize == 1 and dset.dtype.kind in 'biu':
+        buf = np.empty(dset.shape, dtype=dset.dtype)
+        dset.read_direct(buf)
+        mask = buf.view(bool)
+        np.not_equal(buf, 0, out=mask)
+        return mask
+    return dset[()].astype(bool)
+
 def select_file(title, filetypes):
     """Helper to open a file dialog and return the selected file path."""
     return filedialog.askopenfilename(
@@ -117,11 +131,12 @@ def get_ui(parent):
         
         try:
             with h5py.File(mask_file, 'r') as f_mask:
+                dset = f_mask['/mask']
                 if use_mask_var.get():
-                    mask = f_mask['/mask'][:].astype(bool)
+                    mask = read_mask(dset)
                 else:
-                    sample = f_mask['/mask'][0]
-                    mask = np.ones_like(sample, dtype=bool)
+                    # Only the frame shape is needed, which comes from the metadata.
+                    mask = np.ones(dset.shape[-2:], dtype=bool)
         except Exception as e:
             print("Error loading mask file:", e)
             messagebox.showerror("Error", "Error loading mask file:\n" + str(e))
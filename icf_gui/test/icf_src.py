@@ -4,175 +4,291 @@ import numpy as np
 from scipy.optimize import minimize
 import numba
 
+@numba.njit(parallel=True, cache=True)
+def center_of_mass_sums(image, mask):
+    """
+    Sums over the valid pixels in one row-parallel pass, without index grids or
+    masked copies. Returns (total intensity, sum of x*intensity, sum of y*intensity).
+    """
+    rows, cols = image.shape
+    s = 0.0
+    sx = 0.0
+    sy = 0.0
+    for y in numba.prange(rows):
+        for x in range(cols):
+            if mask[y, x]:
+                v = np.float64(image[y, x])
+                s += v
+                sx += x * v
+                sy += y * v
+    return s, sx, sy
+
+
 def center_of_mass_initial_guess(image, mask):
     """
     Compute a rough center-of-mass (CoM) for the image using valid pixels only.
     Returns (cx, cy).
     """
-    rows, cols = np.indices(image.shape)
-    valid_intensity = image[mask]
-    valid_rows = rows[mask]
-    valid_cols = cols[mask]
-    total_intensity = np.sum(valid_intensity)
+    total_intensity, sum_x, sum_y = center_of_mass_sums(image, mask)
     if total_intensity == 0:
         # Default to geometric center
         return (image.shape[1] / 2.0, image.shape[0] / 2.0)
-    cx = np.sum(valid_cols * valid_intensity) / total_intensity
-    cy = np.sum(valid_rows * valid_intensity) / total_intensity
+    cx = sum_x / total_intensity
+    cy = sum_y / total_intensity
     return (cx, cy)
 
 
-@numba.njit
-def compute_bin_medians(wedge_vals, bin_indices, n_bins):
-    """
-    Given wedge_vals and bin_indices, compute the median per bin.
-    Any bin with no values or any NaN => np.nan for that bin.
-    """
-    result = np.empty(n_bins, dtype=np.float64)
-    for bin_i in range(n_bins):
-        count = 0
-        any_nan = False
-        # First pass: count values & check NaNs
-        for j in range(wedge_vals.shape[0]):
-            if bin_indices[j] == bin_i:
-                if np.isnan(wedge_vals[j]):
-                    any_nan = True
-                count += 1
-        if count == 0 or any_nan:
-            result[bin_i] = np.nan
-        else:
-            # Collect and sort values
-            tmp = np.empty(count, dtype=np.float64)
-            k = 0
-            for j in range(wedge_vals.shape[0]):
-                if bin_indices[j] == bin_i:
-                    tmp[k] = wedge_vals[j]
-                    k += 1
-            tmp.sort()
-            if count % 2 == 1:
-                result[bin_i] = tmp[count // 2]
-            else:
-                mid = count // 2
-                result[bin_i] = 0.5 * (tmp[mid - 1] + tmp[mid])
-    return result
-
-
-def build_symmetric_mask_fast(image_shape, global_mask, center_yx):
-    """
-    Fast approach for ensuring mirrored pixels are both valid or both invalid.
-    center_yx = (cy, cx).
-    Returns a 2D boolean mask.
+@numba.njit(parallel=True, cache=True, boundscheck=False)
+def build_symmetric_mask_into(sym_valid, global_mask, cy, cx):
     """
-    rows, cols = image_shape
-    cy, cx = center_yx
-
-    y_indices, x_indices = np.indices(image_shape)
-    y_flat = y_indices.ravel()
-    x_flat = x_indices.ravel()
-    N = y_flat.size
-
-    global_valid = global_mask.ravel()
-    sym_valid = np.zeros_like(global_valid, dtype=np.bool_)
-
-    # Round mirror coords
-    mirror_x = np.round(2.0*cx - x_flat).astype(np.int32)
-    mirror_y = np.round(2.0*cy - y_flat).astype(np.int32)
-
-    # Flattened mirror index
-    mirror_index = np.full(N, -1, dtype=np.int64)
-    for i in range(N):
-        mx = mirror_x[i]
-        my = mirror_y[i]
-        if (0 <= mx < cols) and (0 <= my < rows):
-            mirror_index[i] = my * cols + mx
-
-    # Single pass to mark pairs
-    for i in range(N):
-        j = mirror_index[i]
-        if j < 0:
+    Fast approach for ensuring mirrored pixels are both valid or both invalid,
+    writing the mask into the preallocated boolean array sym_valid (same shape as
+    global_mask), so repeated calls do not allocate.
+    Mirror coordinates are rounded; a pair is marked from its lower (row-major)
+    pixel, which also covers a pixel that is its own mirror (exactly on the center).
+    Rows run in parallel, without temporary arrays, when called directly; in the
+    center-finding pool worker_init caps Numba at one thread per worker, so the
+    pool does not oversubscribe the cores.
+    Returns sym_valid.
+    """
+    rows, cols = global_mask.shape
+    # Clear the buffer first: the marking pass also writes into other rows.
+    for y in numba.prange(rows):
+        for x in range(cols):
+            sym_valid[y, x] = False
+    for y in numba.prange(rows):
+        my = np.int64(np.round(2.0*cy - y))
+        if my < 0 or my >= rows:
             continue  # out of range => exclude
-        if j > i:
-            if global_valid[i] and global_valid[j]:
-                sym_valid[i] = True
-                sym_valid[j] = True
-        elif j == i:
-            # Pixel is its own mirror (exactly on the center)
-            if global_valid[i]:
-                sym_valid[i] = True
-        # if j < i, it was handled already
+        for x in range(cols):
+            mx = np.int64(np.round(2.0*cx - x))
+            if mx < 0 or mx >= cols:
+                continue
+            # Pairs with the mirror earlier in row-major order were handled from there.
+            if my * cols + mx < y * cols + x:
+                continue
+            if global_mask[y, x] and global_mask[my, mx]:
+                # Both pixels only ever get True, so writes from other rows cannot conflict.
+                sym_valid[y, x] = True
+                sym_valid[my, mx] = True
+    return sym_valid
+
+
+@numba.njit(cache=True)
+def build_symmetric_mask_fast(global_mask, cy, cx):
+    """
+    Symmetric mask in a new array (see build_symmetric_mask_into).
+    Returns a 2D boolean mask.
+    """
+    sym_valid = np.empty(global_mask.shape, dtype=np.bool_)
+    return build_symmetric_mask_into(sym_valid, global_mask, cy, cx)
+
+
+@numba.njit(cache=True)
+def nth_element(a, k):
+    """
+    Quickselect: reorders a in place so that a[k] is the value a sorted copy would
+    have there, with no larger value before it and no smaller value after it.
+    Hoare partitioning around a median-of-three pivot; O(len(a)) on average.
+    Returns a[k].
+    """
+    lo = 0
+    hi = a.shape[0] - 1
+    while hi > lo:
+        mid = (lo + hi) // 2
+        if a[mid] < a[lo]:
+            a[mid], a[lo] = a[lo], a[mid]
+        if a[hi] < a[lo]:
+            a[hi], a[lo] = a[lo], a[hi]
+        if a[hi] < a[mid]:
+            a[hi], a[mid] = a[mid], a[hi]
+        pivot = a[mid]
+        i = lo
+        j = hi
+        while i <= j:
+            while a[i] < pivot:
+                i += 1
+            while a[j] > pivot:
+                j -= 1
+            if i <= j:
+                a[i], a[j] = a[j], a[i]
+                i += 1
+                j -= 1
+        if k <= j:
+            hi = j
+        elif k >= i:
+            lo = i
+        else:
+            break
+    return a[k]
+
+
+@numba.njit(parallel=True, cache=True)
+def wedge_profiles_kernel(image, mask, base_x, base_y, shift_x, shift_y, r_edges, n_wedges, cell):
+    """
+    Radial median profiles of all wedges in one pass over the pixels, for the
+    center shifted by (shift_x, shift_y) from the base center (base_x, base_y).
+    Each valid pixel is assigned to its (wedge, radial bin) cell, the values are
+    gathered per cell (CSR layout: count, offsets, fill) and the median of every
+    cell is taken in parallel (on one thread per worker inside the center-finding
+    pool, where worker_init caps Numba's threads). Any cell with no values or any
+    NaN => np.nan.
+    Wedge w covers -pi + w*step <= theta < -pi + (w+1)*step and bin b covers
+    r_edges[b] <= r < r_edges[b+1], as with the per-wedge masks and np.digitize.
+    r_edges must be evenly spaced (np.linspace). cell is an int64 scratch array with one
+    entry per pixel, overwritten on every call.
+    Returns an (n_wedges, n_bins) array.
+    """
+    rows, cols = image.shape
+    n_bins = r_edges.shape[0] - 1
+    wedge_step = 2*np.pi / n_wedges
+    r_min = r_edges[0]
+    inv_dr = n_bins / (r_edges[n_bins] - r_min)
 
-    return sym_valid.reshape(image_shape)
+    # 1) Cell of every pixel (-1 = masked or outside all wedges/bins).
+    for y in numba.prange(rows):
+        for x in range(cols):
+            i = y * cols + x
+            cell[i] = -1
+            if not mask[y, x]:
+                continue
+            # Offsets from the pixel indices, with the same operations as subtracting the
+            # shift from precomputed (cols - base_x, rows - base_y) grids, but without
+            # reading any full-image coordinate arrays.
+            dx = (x - base_x) - shift_x
+            dy = (y - base_y) - shift_y
+            theta = np.arctan2(dy, dx)
+            # Estimate the wedge, then settle it with the exact boundary comparisons.
+            w = int(np.floor((theta + np.pi) / wedge_step))
+            w = min(max(w, 0), n_wedges - 1)
+            if theta < -np.pi + w * wedge_step:
+                w -= 1
+            elif theta >= -np.pi + (w + 1) * wedge_step:
+                w += 1
+            if w < 0 or w >= n_wedges:
+                continue
+            # The radial bins are uniform (linspace), so the bin follows from r directly;
+            # the edge comparisons only settle values that round onto an edge.
+            r = np.sqrt(dx**2 + dy**2)
+            b = int(np.floor((r - r_min) * inv_dr))
+            b = min(max(b, 0), n_bins - 1)
+            if r < r_edges[b]:
+                b -= 1
+            elif r >= r_edges[b + 1]:
+                b += 1
+            if b < 0 or b >= n_bins:
+                continue
+            cell[i] = w * n_bins + b
+
+    # 2) Gather the values of each cell contiguously.
+    n_cells = n_wedges * n_bins
+    counts = np.zeros(n_cells, dtype=np.int64)
+    for i in range(cell.shape[0]):
+        if cell[i] >= 0:
+            counts[cell[i]] += 1
+    offsets = np.zeros(n_cells + 1, dtype=np.int64)
+    for c in range(n_cells):
+        offsets[c + 1] = offsets[c] + counts[c]
+    vals = np.empty(offsets[n_cells], dtype=np.float64)
+    fill = offsets[:n_cells].copy()
+    any_nan = np.zeros(n_cells, dtype=np.bool_)
+    flat = image.ravel()
+    for i in range(cell.shape[0]):
+        c = cell[i]
+        if c >= 0:
+            v = flat[i]
+            if np.isnan(v):
+                any_nan[c] = True
+            vals[fill[c]] = v
+            fill[c] += 1
+
+    # 3) Median per cell, selected in place in the gathered values (no sort, no copy).
+    profiles = np.empty((n_wedges, n_bins), dtype=np.float64)
+    for c in numba.prange(n_cells):
+        count = counts[c]
+        if count == 0 or any_nan[c]:
+            profiles[c // n_bins, c % n_bins] = np.nan
+            continue
+        tmp = vals[offsets[c]:offsets[c + 1]]
+        mid = count // 2
+        upper = nth_element(tmp, mid)
+        if count % 2 == 1:
+            profiles[c // n_bins, c % n_bins] = upper
+        else:
+            # The lower middle value is the largest value left of the selected one.
+            lower = tmp[0]
+            for j in range(1, mid):
+                if tmp[j] > lower:
+                    lower = tmp[j]
+            profiles[c // n_bins, c % n_bins] = 0.5 * (lower + upper)
+    return profiles
 
 
 def compute_wedge_radial_profiles(image, mask, base_center, center,
-                                  dx_base, dy_base,
                                   n_wedges=8, n_rad_bins=200,
-                                  r_min=0, r_max=None):
+                                  r_min=0, r_max=None, r_edges=None, cell_buf=None):
     """
     Compute radial profiles for image wedges using a shifted center.
-    Returns (wedge_profiles, r_centers).
+    r_edges, if given, are the radial bin edges (computed once by the caller);
+    otherwise they are built from r_min, r_max and n_rad_bins.
+    cell_buf, if given, is an int64 scratch array with image.size entries that the
+    kernel reuses instead of allocating its own.
+    Returns (wedge_profiles, r_centers); wedge_profiles has one row per wedge.
     """
     shift = (center[0] - base_center[0], center[1] - base_center[1])
-    new_dx = dx_base - shift[0]
-    new_dy = dy_base - shift[1]
-    r = np.sqrt(new_dx**2 + new_dy**2)
-    theta = np.arctan2(new_dy, new_dx)
 
-    if r_max is None:
-        r_max = min(image.shape) / 2.0
-    r_edges = np.linspace(r_min, r_max, n_rad_bins + 1)
+    if r_edges is None:
+        if r_max is None:
+            r_max = min(image.shape) / 2.0
+        r_edges = np.linspace(r_min, r_max, n_rad_bins + 1)
 
-    wedge_profiles = []
-    wedge_step = 2*np.pi / n_wedges
+    if cell_buf is None:
+        cell_buf = np.empty(image.size, dtype=np.int64)
 
-    for w in range(n_wedges):
-        angle_min = -np.pi + w * wedge_step
-        angle_max = -np.pi + (w + 1) * wedge_step
-        wedge_mask = (theta >= angle_min) & (theta < angle_max) & mask
-        r_wedge = r[wedge_mask]
-        wedge_vals = image[wedge_mask]
-        bin_indices = np.digitize(r_wedge, r_edges) - 1
-        profile = compute_bin_medians(wedge_vals, bin_indices, n_rad_bins)
-        wedge_profiles.append(profile)
+    wedge_profiles = wedge_profiles_kernel(image, mask, base_center[0], base_center[1],
+                                           shift[0], shift[1], r_edges, n_wedges, cell_buf)
 
     r_centers = 0.5 * (r_edges[:-1] + r_edges[1:])
     return wedge_profiles, r_centers
 
 
 def center_asymmetry_metric(candidate_center, image, global_mask,
-                            base_center, dx_base, dy_base,
-                            n_wedges=4, n_rad_bins=100, debug=False):
+                            base_center,
+                            n_wedges=4, n_rad_bins=100, debug=False, r_edges=None,
+                            sym_buf=None, cell_buf=None):
     """
     Compute the asymmetry metric with mirrored-pixel exclusion:
     - Build symmetric mask
     - Compute wedge profiles
     - Compare opposite wedges
+    sym_buf (bool, image shape) and cell_buf (int64, image.size), if given, are scratch
+    buffers reused across calls, so the optimizer does not allocate them per evaluation.
     """
     # Because code typically uses (cx, cy), but mask-building uses (cy, cx),
     # we swap the candidate_center here:
-    cy_cx = (candidate_center[1], candidate_center[0])
-    sym_mask = build_symmetric_mask_fast(image.shape, global_mask, cy_cx)
+    if sym_buf is None:
+        sym_mask = build_symmetric_mask_fast(global_mask, candidate_center[1], candidate_center[0])
+    else:
+        sym_mask = build_symmetric_mask_into(sym_buf, global_mask, candidate_center[1], candidate_center[0])
 
     wedge_profiles, _ = compute_wedge_radial_profiles(
         image, sym_mask,
         base_center, candidate_center,
-        dx_base, dy_base,
-        n_wedges=n_wedges, n_rad_bins=n_rad_bins
+        n_wedges=n_wedges, n_rad_bins=n_rad_bins, r_edges=r_edges, cell_buf=cell_buf
     )
 
+    # Compare all opposite wedge pairs at once; bins that are NaN in either wedge of a
+    # pair (including every bin of a wedge with no valid pixels) do not count.
     half = n_wedges // 2
-    total_diff = 0.0
-    count = 0
-    for i in range(half):
-        p1 = wedge_profiles[i]
-        p2 = wedge_profiles[i + half]
-        valid = ~np.isnan(p1) & ~np.isnan(p2)
-        if np.any(valid):
-            diff = p1[valid] - p2[valid]
-            total_diff += np.sum(diff**2)
-            count += np.sum(valid)
-
-    metric_val = total_diff / count if count > 0 else np.inf
+    p1 = wedge_profiles[:half]
+    p2 = wedge_profiles[half:2 * half]
+    valid = ~np.isnan(p1) & ~np.isnan(p2)
+    count = np.count_nonzero(valid)
+    if count > 0:
+        diff = p1[valid] - p2[valid]
+        metric_val = np.dot(diff, diff) / count
+    else:
+        metric_val = np.inf
     if debug:
         print(f"Candidate center: {candidate_center}, Metric: {metric_val}")
     return metric_val
@@ -181,24 +297,32 @@ def center_asymmetry_metric(candidate_center, image, global_mask,
 def find_diffraction_center(image, mask, initial_center=None,
                             n_wedges=4, n_rad_bins=100,
                             xatol=1e-1, fatol=1e-1,
-                            verbose=True, skip_tol=3.0):
+                            verbose=True, skip_tol=3.0, method='Nelder-Mead'):
     """
     Main entry point for refining the diffraction center.
+    method is the scipy.optimize.minimize method: 'Nelder-Mead' (default) or 'Powell',
+    with xatol/fatol passed as its xtol/ftol. The metric is built from bin medians and
+    is not smooth, so gradient-based methods do not apply.
     """
+    if method not in ('Nelder-Mead', 'Powell'):
+        raise ValueError(f"method must be 'Nelder-Mead' or 'Powell', not {method!r}.")
     if initial_center is None:
         initial_center = center_of_mass_initial_guess(image, mask)
     if verbose:
         print("Starting center refinement with initial center:", initial_center)
 
-    rows, cols = np.indices(image.shape)
-    dx_base = cols - initial_center[0]
-    dy_base = rows - initial_center[1]
+    # The radial bins do not depend on the candidate center; build them once.
+    r_edges = np.linspace(0, min(image.shape) / 2.0, n_rad_bins + 1)
+    # Scratch buffers for the symmetric mask and the pixel cells, shared by all evaluations.
+    sym_buf = np.empty(image.shape, dtype=np.bool_)
+    cell_buf = np.empty(image.size, dtype=np.int64)
 
     # Evaluate metric at the initial center
     initial_metric = center_asymmetry_metric(
         initial_center, image, mask,
-        initial_center, dx_base, dy_base,
-        n_wedges=n_wedges, n_rad_bins=n_rad_bins, debug=verbose
+        initial_center,
+        n_wedges=n_wedges, n_rad_bins=n_rad_bins, debug=verbose, r_edges=r_edges,
+        sym_buf=sym_buf, cell_buf=cell_buf
     )
     if verbose:
         print("Metric at initial center:", initial_metric)
@@ -213,15 +337,34 @@ def find_diffraction_center(image, mask, initial_center=None,
     if verbose:
         print("Initial center (x0):", x0)
 
+    if method == 'Powell':
+        options = {'xtol': xatol, 'ftol': fatol, 'maxiter': 300}
+    else:
+        options = {'xatol': xatol, 'fatol': fatol, 'maxiter': 300}
     res = minimize(
         center_asymmetry_metric,
         x0,
-        args=(image, mask, initial_center, dx_base, dy_base, n_wedges, n_rad_bins, verbose),
-        method='Nelder-Mead',
-        options={'xatol': xatol, 'fatol': fatol, 'maxiter': 300}
+        args=(image, mask, initial_center, n_wedges, n_rad_bins, verbose, r_edges, sym_buf, cell_buf),
+        method=method,
+        options=options
     )
     refined_center = res.x
     if verbose:
         print("Final refined center:", refined_center)
 
     return tuple(refined_center)
+
+
+def warm_up_kernels():
+    """
+    Compile (or load from Numba's on-disk cache) the kernels used by
+    find_diffraction_center, on a tiny float32 image. Each pool worker calls this
+    in its initializer, so it loads the cached kernels once before its first task
+    rather than on its first frame.
+    """
+    image = np.ones((16, 16), dtype=np.float32)
+    mask = np.ones((16, 16), dtype=bool)
+    initial_center = center_of_mass_initial_guess(image, mask)
+    # A uniform image is perfectly symmetric, so this evaluates the metric once and returns.
+    find_diffraction_center(image, mask, initial_center=initial_center,
+                            n_rad_bins=4, verbose=False, skip_tol=np.inf)
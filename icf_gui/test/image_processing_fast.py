@@ -1,17 +1,27 @@
 import os
 import h5py
 import numpy as np
+import numba
 import pandas as pd
-from multiprocessing import Pool
+from multiprocessing import Pool, shared_memory
 from tqdm import tqdm
 
+# pyarrow's CSV writer is much faster than DataFrame.to_csv; fall back to pandas without it.
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
 # Import the center-finding code
-from icf_src import center_of_mass_initial_guess, find_diffraction_center
+from icf_src import center_of_mass_initial_guess, find_diffraction_center, warm_up_kernels
 
 ###############################################################################
 # Global variables in each worker (populated by worker_init)
 images_dset = None
 global_mask = None
+mask_shm = None  # keeps the shared-memory block behind global_mask attached
+frames_buf = None  # float32 scratch buffer the frame batches are read into
 
 # Optional: store n_wedges, n_rad_bins, etc. if you like
 n_wedges_global = 4
@@ -25,25 +35,37 @@ ymin_global = 0
 ymax_global = 1024
 
 ###############################################################################
-def worker_init(h5_path, mask_array,
+def chunk_cache_nbytes(dset, min_nbytes=64 * 1024 * 1024):
+    """
+    HDF5 chunk-cache size for reading dset: at least min_nbytes, and room for two chunks
+    (a chunk larger than the cache is not cached at all).
+    """
+    if dset.chunks is None:
+        return min_nbytes
+    return max(min_nbytes, 2 * int(np.prod(dset.chunks)) * dset.dtype.itemsize)
+
+def worker_init(h5_path, cache_nbytes, shm_name, mask_shape, mask_dtype,
                 n_wedges, n_rad_bins, xatol, fatol,
                 verbose, xmin, xmax, ymin, ymax):
     """
     Called once per worker process.  
     We open the HDF5 file in read-only mode and store relevant globals.
     """
-    global images_dset, global_mask
+    global images_dset, global_mask, mask_shm
     global n_wedges_global, n_rad_bins_global
     global xatol_global, fatol_global, verbose_global
     global xmin_global, xmax_global, ymin_global, ymax_global
 
-    # Open the file (SWMR if available), read-only
+    # Open the file (SWMR if available), read-only, with a chunk cache that holds whole
+    # image chunks so neighbouring frames are not decompressed again.
     # If your HDF5 build doesn't support swmr=True, you can omit it
-    file_obj = h5py.File(h5_path, 'r', swmr=True)
+    file_obj = h5py.File(h5_path, 'r', swmr=True, rdcc_nbytes=cache_nbytes, rdcc_nslots=10007)
     images_dset = file_obj['/entry/data/images']  # store handle to dataset
 
-    # Store mask in global variable
-    global_mask = mask_array
+    # Attach to the mask in shared memory and keep a read-only view of it in a global variable
+    mask_shm = shared_memory.SharedMemory(name=shm_name)
+    global_mask = np.ndarray(mask_shape, dtype=mask_dtype, buffer=mask_shm.buf)
+    global_mask.flags.writeable = False
 
     # Store other parameters
     n_wedges_global = n_wedges
@@ -54,20 +76,88 @@ def worker_init(h5_path, mask_array,
     xmin_global, xmax_global = xmin, xmax
     ymin_global, ymax_global = ymin, ymax
 
+    # The pool already runs one worker per core, so each worker runs the parallel
+    # Numba kernels on a single thread instead of starting a core-sized thread pool.
+    numba.set_num_threads(1)
+    # Compile (or load from the Numba cache) the kernels before the first frame arrives.
+    warm_up_kernels()
+
+
+def split_frames_by_chunk(frames, chunk_len, max_frames):
+    """
+    Splits sorted frame numbers into groups of about max_frames frames without separating
+    frames that live in the same HDF5 chunk (chunk_len frames along axis 0), so every
+    touched chunk is read and decompressed (and held in a chunk cache) by a single worker.
+    """
+    groups = []
+    current = []
+    for fn in frames:
+        if len(current) >= max_frames and fn // chunk_len != current[-1] // chunk_len:
+            groups.append(current)
+            current = []
+        current.append(fn)
+    if current:
+        groups.append(current)
+    return groups
+
+
+def read_index_for_frames(index_dset, n_images, frame_interval):
+    """
+    Reads the data index of every frame_interval-th frame plus the last frame, i.e. of the
+    frames to process, with one strided read instead of loading the whole index dataset
+    (an h5py fancy selection of the same frames is far slower than either).
+    """
+    data_index = index_dset[::frame_interval]
+    if (n_images - 1) % frame_interval:
+        data_index = np.append(data_index, index_dset[n_images - 1])
+    return data_index
+
 
-def process_one_frame(frame_num):
+def read_frames(dset, frame_nums, out):
     """
-    Each worker uses this to process a single frame, returning (frame_num, cx, cy).
+    Reads the given increasing frame numbers into the float32 buffer out (at least
+    len(frame_nums) frames long) with a single H5 read: an evenly spaced run becomes one
+    strided hyperslab, anything else one point selection. HDF5 converts the dtype during
+    the read, so no converted copy of the frames is made. Returns the filled part of out.
     """
-    global images_dset, global_mask
+    frames = out[:len(frame_nums)]
+    if len(frame_nums) == 1:
+        sel = np.s_[frame_nums[0]:frame_nums[0] + 1]
+    else:
+        step = frame_nums[1] - frame_nums[0]
+        if all(b - a == step for a, b in zip(frame_nums, frame_nums[1:])):
+            sel = np.s_[frame_nums[0]:frame_nums[-1] + 1:step]
+        else:
+            sel = np.s_[list(frame_nums)]
+    dset.read_direct(frames, source_sel=sel)
+    return frames
+
+
+def process_frame_batch(frame_nums):
+    """
+    Each worker uses this to process a batch of increasing frame numbers, read from the
+    globally opened dataset with one H5 read. Returns a list of (frame_num, cx, cy).
+    """
+    global images_dset, frames_buf
+
+    # Read the batch straight into the worker's float32 scratch buffer, grown only when
+    # a batch is longer than any before it.
+    if frames_buf is None or len(frames_buf) < len(frame_nums):
+        frames_buf = np.empty((len(frame_nums),) + images_dset.shape[1:], dtype=np.float32)
+    frames = read_frames(images_dset, frame_nums, frames_buf)
+    return [process_one_frame(frame_num, img) for frame_num, img in zip(frame_nums, frames)]
+
+
+def process_one_frame(frame_num, img):
+    """
+    Processes a single frame (already loaded as float32), returning (frame_num, cx, cy).
+    """
+    global global_mask
     global n_wedges_global, n_rad_bins_global
     global xatol_global, fatol_global, verbose_global
     global xmin_global, xmax_global
     global ymin_global, ymax_global
 
-    # Load the image from the globally opened dataset
-    img = images_dset[frame_num].astype(np.float32)
-
     # 1) Compute center-of-mass guess
     init_center = center_of_mass_initial_guess(img, global_mask)
 
@@ -110,65 +200,98 @@ def process_images_apply_async(
     xmax=1024,
     ymin=0,
     ymax=1024,
-    verbose=False
+    verbose=False,
+    frames_per_batch=16
 ):
     """
     Multiprocessing routine using an initializer for each worker.
     Reads frames from image_file, finds centers, writes to CSV.
+    Frames are handed out in batches of about frames_per_batch consecutive frames to
+    process, aligned to the HDF5 chunks, which each worker reads with a single H5 read.
     """
-    # 1) Open H5 file on main process just to get total frames & index
+    # 1) Open H5 file on main process just to get total frames, the frames to process
+    #    and their index (one strided read plus the last frame, not the whole index)
     with h5py.File(image_file, 'r') as f:
         n_images = f['/entry/data/images'].shape[0]
+        cache_nbytes = chunk_cache_nbytes(f['/entry/data/images'])
+        chunks = f['/entry/data/images'].chunks
+        chunk_len = chunks[0] if chunks is not None else 1
+        frames_to_process = np.union1d(np.arange(0, n_images, frame_interval), [0, n_images - 1])
         index_dset = f.get('/entry/data/index')
         if index_dset is not None:
-            data_index_all = index_dset[:]
+            data_index_sel = read_index_for_frames(index_dset, n_images, frame_interval)
         else:
             raise ValueError("'/entry/data/index' not found.")
 
-    # 2) Prepare a DataFrame
+    # 2) Preallocate the centers, one entry per frame to process
+    center_x = np.full(len(frames_to_process), np.nan, dtype=float)
+    center_y = np.full(len(frames_to_process), np.nan, dtype=float)
+
+    # 3) Create a Pool with our worker_init
+    #    Each worker: opens the file, sets global_mask, etc.
+    #    The mask is copied once into shared memory, which every worker attaches to,
+    #    so it is neither pickled per worker nor duplicated in each process.
+    mask = np.asarray(mask, dtype=bool)
+    shm = shared_memory.SharedMemory(create=True, size=max(mask.nbytes, 1))
+    try:
+        shm_mask = np.ndarray(mask.shape, dtype=mask.dtype, buffer=shm.buf)
+        shm_mask[:] = mask
+        n_procs = os.cpu_count()
+        with Pool(
+            processes=n_procs,
+            initializer=worker_init,
+            initargs=(
+                image_file,
+                cache_nbytes,
+                shm.name, mask.shape, mask.dtype.str,
+                n_wedges, n_rad_bins,
+                xatol, fatol,
+                verbose,
+                xmin, xmax,
+                ymin, ymax
+            )
+        ) as pool:
+
+            # 4) Use imap_unordered for efficient scheduling; the batches are sent in chunks of
+            #    about a quarter of each worker's share, so there are fewer IPC round-trips
+            #    while the load still balances (chunksize 1 for short runs).
+            #    Batches never split an HDF5 chunk, so no chunk is decompressed by two workers.
+            batches = split_frames_by_chunk(frames_to_process.tolist(), chunk_len, frames_per_batch)
+            chunksize = max(1, len(batches) // (n_procs * 4))
+            results_iter = pool.imap_unordered(process_frame_batch, batches, chunksize=chunksize)
+
+            # 5) Store the centers of each finished batch in the arrays (one vectorized
+            #    assignment per batch) and update the progress bar
+            with tqdm(total=len(frames_to_process), desc="Processing frames", unit="frame") as pbar:
+                for batch_results in results_iter:
+                    frame_nums, cxs, cys = zip(*batch_results)
+                    rows = np.searchsorted(frames_to_process, frame_nums)
+                    center_x[rows] = cxs
+                    center_y[rows] = cys
+                    pbar.update(len(batch_results))
+            # Let the workers exit on their own (leaving the block would terminate them).
+            pool.close()
+            pool.join()
+        del shm_mask
+    finally:
+        shm.close()
+        shm.unlink()
+
+    # Build the DataFrame once, with the center columns complete
     df = pd.DataFrame({
-        "frame_number": np.arange(n_images),
-        "data_index": data_index_all,
-        "center_x": np.full(n_images, np.nan, dtype=float),
-        "center_y": np.full(n_images, np.nan, dtype=float),
+        "frame_number": frames_to_process,
+        "data_index": data_index_sel,
+        "center_x": center_x,
+        "center_y": center_y,
     })
 
-    # 3) Determine which frames to process
-    frames_to_process = set([0, n_images - 1]) | {i for i in range(n_images) if i % frame_interval == 0}
-    frames_to_process = sorted(frames_to_process)
-
-    # 4) Create a Pool with our worker_init
-    #    Each worker: opens the file, sets global_mask, etc.
-    with Pool(
-        processes=None,  # or a fixed number if you prefer
-        initializer=worker_init,
-        initargs=(
-            image_file,
-            mask,
-            n_wedges, n_rad_bins,
-            xatol, fatol,
-            verbose,
-            xmin, xmax,
-            ymin, ymax
-        )
-    ) as pool:
-
-        # 5) Use imap_unordered for efficient scheduling
-        results_iter = pool.imap_unordered(process_one_frame, frames_to_process)
-
-        # 6) Collect results in a progress bar
-        for (frame_num, cx, cy) in tqdm(results_iter,
-                                        total=len(frames_to_process),
-                                        desc="Processing frames",
-                                        unit="frame"):
-            df.at[frame_num, "center_x"] = cx
-            df.at[frame_num, "center_y"] = cy
-
-    # 7) Keep only the processed frames, write CSV
-    df = df[df["frame_number"].isin(frames_to_process)]
+    # 6) Write CSV
     csv_file = os.path.join(
         os.path.dirname(image_file),
         f"centers_xatol_{xatol}_frameinterval_{frame_interval}.csv"
     )
-    df.to_csv(csv_file, index=False)
+    if pa is not None:
+        pa_csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), csv_file)
+    else:
+        df.to_csv(csv_file, index=False)
     print(f"Saved {len(df)} centers to:\n{csv_file}")
@@ -37,7 +37,6 @@ Requires **numpy** and **matplotlib**.
 import argparse
 import re
 import sys
-from pathlib import Path
 from typing import List, Tuple, Iterable, Optional
 
 import numpy as np
@@ -47,15 +46,22 @@ import matplotlib.pyplot as plt
 # Parsing helpers
 # -----------------------------------------------------------------------------
 
+# Compiled once at import instead of being looked up for every event and line.
+_PEAKS_RE = re.compile(r"Peaks from peak search(.*?)End of peak list", re.S)
+_REFLS_RE = re.compile(r"Reflections measured after indexing(.*?)End of reflections", re.S)
+_DIGIT_RE = re.compile(r"^[0-9]")
+_SIGNED_DIGIT_RE = re.compile(r"^[0-9\-]")
+
+
 def _parse_peaks(block: str) -> List[Tuple[float, float]]:
     """Return list of (fs, ss) peaks from a chunk."""
-    m = re.search(r"Peaks from peak search(.*?)End of peak list", block, re.S)
+    m = _PEAKS_RE.search(block)
     if not m:
         return []
     peaks = []
     for line in m.group(1).strip().splitlines():
         line = line.strip()
-        if re.match(r"^[0-9]", line):
+        if _DIGIT_RE.match(line):
             parts = line.split()
             peaks.append((float(parts[0]), float(parts[1])))
     return peaks
@@ -63,16 +69,14 @@ def _parse_peaks(block: str) -> List[Tuple[float, float]]:
 
 def _parse_reflections(block: str) -> List[Tuple[float, float]]:
     """Return list of (fs, ss) reflections from a chunk."""
-    m = re.search(
-        r"Reflections measured after indexing(.*?)End of reflections", block, re.S
-    )
+    m = _REFLS_RE.search(block)
     if not m:
         return []
     refls = []
     for line in m.group(1).strip().splitlines():
         line = line.strip()
         # first token is h index (may be negative)
-        if re.match(r"^[0-9\-]", line):
+        if _SIGNED_DIGIT_RE.match(line):
             parts = line.split()
             if len(parts) >= 3:
                 try:
@@ -90,65 +94,90 @@ def _radial_diffs(
     cx: float,
     cy: float,
     max_xy_dist: Optional[float] = None,
-):
-    """Yield tuples (r_reflection, delta_r) with an optional distance filter.
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return arrays (r_reflection, delta_r) with an optional distance filter.
 
     A peak contributes only if the Euclidean distance to its closest reflection
-    is ≤ max_xy_dist (if that value is not None).
+    is ≤ max_xy_dist (if that value is not None).  All peaks of the event are
+    matched at once, through the (peaks × reflections) squared-distance matrix.
     """
     refls = np.asarray(refls, dtype=float)
-    if refls.size == 0:
-        return
+    peaks = np.asarray(peaks, dtype=float)
+    if refls.size == 0 or peaks.size == 0:
+        return np.empty(0), np.empty(0)
 
-    # Shift reflections once for speed
+    # Shift peaks and reflections once
     refls_shifted = refls - np.array([[cx, cy]])
+    peaks_shifted = peaks - np.array([[cx, cy]])
     r_refl = np.hypot(refls_shifted[:, 0], refls_shifted[:, 1])
+    r_peak = np.hypot(peaks_shifted[:, 0], peaks_shifted[:, 1])
 
-    for fs_p, ss_p in peaks:
-        u, v = fs_p - cx, ss_p - cy
-        r_peak = np.hypot(u, v)
-
-        # Squared distances to every reflection
-        d2 = (refls_shifted[:, 0] - u) ** 2 + (refls_shifted[:, 1] - v) ** 2
-        i_min = int(np.argmin(d2))
+    # Squared distances from every peak (row) to every reflection (column)
+    d2 = ((peaks_shifted[:, 0, None] - refls_shifted[None, :, 0]) ** 2
+          + (peaks_shifted[:, 1, None] - refls_shifted[None, :, 1]) ** 2)
+    i_min = np.argmin(d2, axis=1)
 
-        # Reject if the nearest reflection is farther than the threshold
-        if max_xy_dist is not None and d2[i_min] > max_xy_dist ** 2:
-            continue
+    # Reject peaks whose nearest reflection is farther than the threshold
+    if max_xy_dist is not None:
+        keep = ~(d2[np.arange(len(i_min)), i_min] > max_xy_dist ** 2)
+        i_min = i_min[keep]
+        r_peak = r_peak[keep]
 
-        yield r_refl[i_min], r_peak - r_refl[i_min]
+    return r_refl[i_min], r_peak - r_refl[i_min]
 
 
 # -----------------------------------------------------------------------------
 # Main driver
 # -----------------------------------------------------------------------------
 
+def _iter_events(lines: Iterable[str], event_re: "re.Pattern[str]") -> Iterable[str]:
+    """Yield the text of each event, from one delimiter line up to the next.
+
+    Lines before the first delimiter (the stream header) are skipped; only one
+    event is held in memory at a time.
+    """
+    buf: Optional[List[str]] = None
+    for line in lines:
+        if event_re.search(line):
+            if buf is not None:
+                yield "".join(buf)
+            buf = [line]
+        elif buf is not None:
+            buf.append(line)
+    if buf is not None:
+        yield "".join(buf)
+
+
 def process_stream(
-    text: str,
+    stream_file: str,
     cx: float = 0.0,
     cy: float = 0.0,
     event_pattern: str = r"^Image filename:",
     max_events: Optional[int] = None,
     max_xy_dist: Optional[float] = None,
 ):
-    """Return two numpy arrays (r_reflection, delta_r) for the whole file."""
+    """Return two numpy arrays (r_reflection, delta_r) for the whole file.
+
+    The stream is read line by line, one event at a time, so memory does not
+    grow with the file size and reading stops after max_events events.
+    """
     event_re = re.compile(event_pattern, re.M)
-    # Split but keep delimiter by using finditer indices
-    indices = [m.start() for m in event_re.finditer(text)] + [None]
-    r_list: List[float] = []
-    d_list: List[float] = []
-
-    for i, start in enumerate(indices[:-1]):
-        end = indices[i + 1]
-        chunk = text[start:end]
-        peaks = _parse_peaks(chunk)
-        refls = _parse_reflections(chunk)
-        for r_ref, d in _radial_diffs(peaks, refls, cx, cy, max_xy_dist):
-            r_list.append(r_ref)
-            d_list.append(d)
-        if max_events is not None and i + 1 >= max_events:
-            break
-    return np.asarray(r_list), np.asarray(d_list)
+    # One small array per event, concatenated once at the end
+    r_chunks: List[np.ndarray] = []
+    d_chunks: List[np.ndarray] = []
+
+    with open(stream_file, "r", buffering=1 << 20) as fh:
+        for i, chunk in enumerate(_iter_events(fh, event_re)):
+            peaks = _parse_peaks(chunk)
+            refls = _parse_reflections(chunk)
+            r_ref, d = _radial_diffs(peaks, refls, cx, cy, max_xy_dist)
+            r_chunks.append(r_ref)
+            d_chunks.append(d)
+            if max_events is not None and i + 1 >= max_events:
+                break
+    if not r_chunks:
+        return np.array([]), np.array([])
+    return np.concatenate(r_chunks), np.concatenate(d_chunks)
 
 
 # -----------------------------------------------------------------------------
@@ -162,10 +191,8 @@ def main(argv=None):
     # Treat zero or negative as 'no filter'
     max_xy_dist = 1
 
-    text = Path(stream_file).read_text()
-
     r_ref, delta = process_stream(
-        text,
+        stream_file,
         cx=502.5,
         cy=510.5,
         max_events=1000,